@@ -28,7 +28,8 @@ python src/translate.py --iterations 50000 --learning_rate 0.005 --residual_velo
 # python src/forward_kinematics.py --sample_name samples_tf.h5 --action_name "${action}_0" --save --save_name "figs/${action}_tf.gif"
 # python src/forward_kinematics.py --sample_name samples_tf.h5 --action_name "${action}_0"
 
-# python src/forward_kinematics.py --sample_name samples.h5 --action_name "${action}_0" --save --save_name "figs/${action}_py.gif"
 # python src/forward_kinematics.py --sample_name samples.h5 --action_name "${action}_0"
-# convert "figs/${action}_py.gif" "cvtpng/${action}_py.png"
 # done
+
+# Render the first seed of every action to figs/${action}_0_py.gif, headless and in parallel
+# python src/render.py --sample_name samples.h5 --out_dir figs --seeds 0 --suffix _py
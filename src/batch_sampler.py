@@ -0,0 +1,140 @@
+"""Vectorized sampling of training batches from packed sequences"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+class BatchSampler(object):
+  def __init__(self, data, source_seq_len, target_seq_len, batch_size, device=None, on_device=False, rng=np.random):
+    """
+    Packs all the sequences of a dataset into one contiguous float32 array, so
+    that a whole batch is drawn with a single gather instead of a Python loop
+    over the batch.
+
+    Args
+      data: dictionary with k:v, k=((subject, action, subsequence, 'even')),
+        v=nxd matrix with a sequence of poses
+      source_seq_len: length of the input sequence.
+      target_seq_len: length of the target sequence.
+      batch_size: the size of the batches to draw.
+      device: device the batches are returned on. None keeps them on the cpu.
+      on_device: whether to keep the packed data on device, so that drawing a
+        batch does not need a host to device copy.
+      rng: numpy RandomState (or np.random itself) used to draw the batches.
+        The default draws exactly the same batches as Seq2SeqModel.get_batch.
+    """
+    self.keys = list( data.keys() )
+    self.source_seq_len = source_seq_len
+    self.target_seq_len = target_seq_len
+    self.batch_size = batch_size
+    self.device = device
+    self.rng = rng
+
+    self.lengths = np.array( [data[k].shape[0] for k in self.keys], dtype=np.int64 )
+    self.offsets = np.concatenate( ([0], np.cumsum(self.lengths)[:-1]) ).astype( np.int64 )
+
+    packed = np.empty( (int(np.sum(self.lengths)), data[self.keys[0]].shape[1]), dtype=np.float32 )
+    for key, offset, length in zip( self.keys, self.offsets, self.lengths ):
+      packed[offset:offset+length] = data[key]
+
+    self.on_device = on_device and device is not None
+    self.packed = torch.from_numpy( packed ).to( device ) if self.on_device else packed
+
+  def sample_indices(self):
+    """
+    Draw the frames of a random batch.
+
+    Returns
+      indices: (source_seq_len + target_seq_len, batch_size) array with the
+        rows of the packed data that make up the batch, time-major
+    """
+    total_frames = self.source_seq_len + self.target_seq_len
+
+    # Select entries at random, and sample somewhere in the middle of each
+    chosen_keys = self.rng.choice( len(self.keys), self.batch_size )
+    idx = self.rng.randint( 16, self.lengths[chosen_keys] - total_frames )
+
+    start = self.offsets[chosen_keys] + idx
+    return start[np.newaxis, :] + np.arange( total_frames )[:, np.newaxis]
+
+  def gather(self, indices, pin_memory=False):
+    """
+    Gather the frames of a batch and split them into the model inputs.
+
+    Args
+      indices: array returned by sample_indices
+      pin_memory: whether to gather into page-locked memory, so that the copy
+        to the device is asynchronous
+    Returns
+      The tuple (encoder_inputs, decoder_inputs, decoder_outputs) of time-major
+      float32 tensors. They are views into a single gathered tensor.
+    """
+    if self.on_device:
+      batch = self.packed[ torch.from_numpy( indices ).to( self.device ) ]
+    else:
+      if pin_memory:
+        batch = torch.empty( indices.shape + self.packed.shape[1:], dtype=torch.float32, pin_memory=True )
+        np.take( self.packed, indices, axis=0, out=batch.numpy() )
+      else:
+        batch = torch.from_numpy( self.packed[indices] )
+      if self.device is not None:
+        batch = batch.to( self.device, non_blocking=pin_memory )
+
+    return (batch[:self.source_seq_len-1],
+            batch[self.source_seq_len-1:self.source_seq_len+self.target_seq_len-1],
+            batch[self.source_seq_len:])
+
+  def get_batch(self):
+    """Draw a random batch, see gather"""
+    return self.gather( self.sample_indices() )
+
+
+class BatchPrefetcher(object):
+  def __init__(self, sampler, depth=2, num_workers=1):
+    """
+    Builds upcoming batches of a BatchSampler in worker threads while the
+    training step runs. Use it as an endless iterator of batches.
+
+    The frames of every batch are drawn from the sampler's rng in the calling
+    thread, in order, so the sequence of batches is the same as calling
+    sampler.get_batch() repeatedly, whatever the depth or number of workers.
+    Only the gather and the copy to the device run in the workers.
+
+    Args
+      sampler: the BatchSampler to draw batches from.
+      depth: number of batches to prepare ahead of time.
+      num_workers: number of threads that gather the batches.
+    """
+    self.sampler = sampler
+    self.depth = max( depth, 1 )
+    self.pin_memory = (sampler.device is not None and torch.device( sampler.device ).type == 'cuda'
+                       and not sampler.on_device)
+    self.executor = ThreadPoolExecutor( max_workers=num_workers )
+    self.pending = collections.deque()
+
+  def _submit(self):
+    indices = self.sampler.sample_indices()
+    self.pending.append( self.executor.submit(self.sampler.gather, indices, self.pin_memory) )
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    while len( self.pending ) < self.depth:
+      self._submit()
+    return self.pending.popleft().result()
+
+  next = __next__
+
+  def close(self):
+    """Stop the workers, dropping the batches that were not used"""
+    for future in self.pending:
+      future.cancel()
+    self.pending.clear()
+    self.executor.shutdown( wait=True )
@@ -0,0 +1,261 @@
+"""Binary, memory-mapped cache of the preprocessed human3.6m sequences.
+
+Parsing the .txt files is by far the slowest part of starting an experiment,
+so the even-subsampled sequences are written once to a single contiguous
+float32 .npy file per set of (subjects, actions, one_hot). An index records
+the offset and length of every (subject, action, subaction, 'even') key, and
+the normalization stats are stored next to it. Every entry also keeps all the
+frames of the source files, one after the other as in the matrix the SRNN code
+computes the normalization stats on. Only the files that changed on disk have
+to be parsed again when the cache is rebuilt, and the stats are still exactly
+those of data_utils.normalization_stats.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import data_utils
+
+CACHE_VERSION = 2
+
+def _cache_key( subjects, actions, one_hot ):
+  """Name of the cache entry for a set of subjects, actions and one-hot setting"""
+  desc = json.dumps( {'version': CACHE_VERSION, 'subjects': [int(s) for s in subjects],
+                      'actions': list(actions), 'one_hot': bool(one_hot)} )
+  return hashlib.sha1( desc.encode('utf-8') ).hexdigest()[:16]
+
+
+def _source_files( path_to_dataset, subjects, actions ):
+  """List the (key, action index, filename) to read, in the same order as data_utils.load_data"""
+  sources = []
+  for subj in subjects:
+    for action_idx, action in enumerate( actions ):
+      for subact in [1, 2]:  # subactions
+        filename = '{0}/S{1}/{2}_{3}.txt'.format( path_to_dataset, subj, action, subact )
+        sources.append( ((subj, action, subact, 'even'), action_idx, filename) )
+  return sources
+
+
+def _signature( filename ):
+  st = os.stat( filename )
+  return [st.st_size, st.st_mtime_ns]
+
+
+def _prepare_sequence( action_sequence, action_idx, nactions, one_hot ):
+  """
+  Prepare the parsed frames of one source file for the cache.
+
+  Returns
+    the_sequence: the even frames, with the one-hot encoding appended if needed
+  """
+  n, d = action_sequence.shape
+  even_list = range(0, n, 2)
+
+  the_sequence = np.zeros( (len(even_list), d + nactions if one_hot else d), dtype=np.float32 )
+  the_sequence[ :, 0:d ] = action_sequence[even_list, :]
+  if one_hot:
+    the_sequence[ :, d+action_idx ] = 1
+  return the_sequence
+
+
+def _read_index( entry_dir ):
+  try:
+    with open( os.path.join(entry_dir, 'index.json') ) as f:
+      index = json.load( f )
+  except (IOError, ValueError):
+    return None
+  if index.get('version') != CACHE_VERSION:
+    return None
+  return index
+
+
+def _read_stats( entry_dir ):
+  stats = np.load( os.path.join(entry_dir, 'stats.npz') )
+  return (stats['data_mean'], stats['data_std'],
+          list(stats['dimensions_to_ignore']), list(stats['dimensions_to_use']))
+
+
+def build_cache( path_to_dataset, cache_dir, subjects, actions, one_hot, num_workers=None ):
+  """
+  Create or update the cache entry for the given subjects, actions and one-hot
+  setting. Only the source files that are new or changed since the last build
+  are parsed again.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    cache_dir: string. directory where the cache entries are stored
+    subjects: list of numbers. The subjects to load
+    actions: list of string. The actions to load
+    one_hot: Whether to add a one-hot encoding to the data
+    num_workers: number of processes used to parse the files, see data_utils.read_csv_files
+  Returns
+    entry_dir: directory of the up-to-date cache entry
+  """
+  entry_dir = os.path.join( cache_dir, _cache_key(subjects, actions, one_hot) )
+  sources   = _source_files( path_to_dataset, subjects, actions )
+  nactions  = len( actions )
+
+  index = _read_index( entry_dir )
+  old_entries = {}
+  if index is not None:
+    old_sequences = np.load( os.path.join(entry_dir, 'sequences.npy'), mmap_mode='r' )
+    old_frames    = np.load( os.path.join(entry_dir, 'frames.npy'), mmap_mode='r' )
+    for i, filename in enumerate( index['sources'] ):
+      old_entries[ filename ] = (index['signatures'][i], index['offsets'][i], index['lengths'][i],
+                                 index['frame_offsets'][i], index['frame_lengths'][i])
+
+  signatures = [_signature( filename ) for _, _, filename in sources]
+  changed = [i for i, (_, _, filename) in enumerate( sources )
+             if filename not in old_entries or old_entries[ filename ][0] != signatures[i]]
+  n_parsed = len( changed )
+
+  if n_parsed > 0:
+    print("Reading {0} changed files".format( n_parsed ))
+  parsed = dict( zip(changed, data_utils.read_csv_files( [sources[i][2] for i in changed], num_workers )) )
+
+  sequences, frames = [], []
+  for i, (key, action_idx, filename) in enumerate( sources ):
+    if i in parsed:
+      action_sequence = parsed.pop(i)
+      sequences.append( _prepare_sequence( action_sequence, action_idx, nactions, one_hot ) )
+      frames.append( action_sequence )
+    else:
+      _, offset, length, frame_offset, frame_length = old_entries[ filename ]
+      sequences.append( old_sequences[offset:offset+length] )
+      frames.append( old_frames[frame_offset:frame_offset+frame_length] )
+
+  if index is not None and n_parsed == 0 and index['sources'] == [s[2] for s in sources]:
+    return entry_dir
+
+  lengths = [s.shape[0] for s in sequences]
+  offsets = np.concatenate( ([0], np.cumsum(lengths)[:-1]) ).tolist()
+  frame_lengths = [f.shape[0] for f in frames]
+  frame_offsets = np.concatenate( ([0], np.cumsum(frame_lengths)[:-1]) ).tolist()
+
+  # The frames are read one file at a time, from the old entry for the unchanged files
+  data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats( frames )
+
+  if not os.path.isdir( entry_dir ):
+    os.makedirs( entry_dir )
+
+  # Write everything under temporary names first, so that an interrupted build
+  # never leaves a half-written entry behind
+  tmp = '.tmp{0}'.format( os.getpid() )
+  packed = np.lib.format.open_memmap( os.path.join(entry_dir, 'sequences' + tmp + '.npy'), mode='w+',
+                                      dtype=np.float32, shape=(sum(lengths), sequences[0].shape[1]) )
+  for offset, the_sequence in zip( offsets, sequences ):
+    packed[offset:offset+the_sequence.shape[0]] = the_sequence
+  packed.flush()
+  all_frames = np.lib.format.open_memmap( os.path.join(entry_dir, 'frames' + tmp + '.npy'), mode='w+',
+                                          dtype=np.float32, shape=(sum(frame_lengths), frames[0].shape[1]) )
+  for frame_offset, action_sequence in zip( frame_offsets, frames ):
+    all_frames[frame_offset:frame_offset+action_sequence.shape[0]] = action_sequence
+  all_frames.flush()
+  del packed, sequences, all_frames, frames
+  if index is not None:
+    del old_sequences, old_frames
+
+  np.savez( os.path.join(entry_dir, 'stats' + tmp + '.npz'), data_mean=data_mean, data_std=data_std,
+            dimensions_to_ignore=np.array(dim_to_ignore, dtype=np.int64),
+            dimensions_to_use=np.array(dim_to_use, dtype=np.int64) )
+  with open( os.path.join(entry_dir, 'index' + tmp + '.json'), 'w' ) as f:
+    json.dump( {'version': CACHE_VERSION,
+                'subjects': [int(s) for s in subjects],
+                'actions': list(actions),
+                'one_hot': bool(one_hot),
+                'keys': [list(s[0]) for s in sources],
+                'sources': [s[2] for s in sources],
+                'signatures': signatures,
+                'offsets': offsets,
+                'lengths': lengths,
+                'frame_offsets': frame_offsets,
+                'frame_lengths': frame_lengths}, f )
+
+  for name in ['sequences.npy', 'frames.npy', 'stats.npz', 'index.json']:
+    base, ext = os.path.splitext( name )
+    os.replace( os.path.join(entry_dir, base + tmp + ext), os.path.join(entry_dir, name) )
+
+  print("Cached {0} sequences ({1} parsed) in {2}".format( len(sources), n_parsed, entry_dir ))
+  return entry_dir
+
+
+def load_data( path_to_dataset, cache_dir, subjects, actions, one_hot, num_workers=None ):
+  """
+  Cached equivalent of data_utils.load_data followed by data_utils.normalization_stats.
+  The sequences are views into a single memory-mapped array.
+
+  Args
+    path_to_dataset: string. directory where the data resides
+    cache_dir: string. directory where the cache entries are stored
+    subjects: list of numbers. The subjects to load
+    actions: list of string. The actions to load
+    one_hot: Whether to add a one-hot encoding to the data
+    num_workers: number of processes used to parse the files, see data_utils.read_csv_files
+  Returns
+    trainData: dictionary with k:v
+      k=(subject, action, subaction, 'even'), v=(nxd) un-normalized data
+    stats: the tuple (data_mean, data_std, dimensions_to_ignore, dimensions_to_use)
+      computed over all the frames of the loaded files
+  """
+  entry_dir = build_cache( path_to_dataset, cache_dir, subjects, actions, one_hot, num_workers )
+  index = _read_index( entry_dir )
+
+  packed = np.load( os.path.join(entry_dir, 'sequences.npy'), mmap_mode='r' )
+  trainData = {}
+  for key, offset, length in zip( index['keys'], index['offsets'], index['lengths'] ):
+    trainData[ tuple(key) ] = packed[offset:offset+length]
+
+  return trainData, _read_stats( entry_dir )
+
+
+def load_stats( cache_dir, subjects, actions, one_hot ):
+  """
+  Read the normalization stats of an existing cache entry, without the dataset.
+  This is all that is needed to feed raw poses to a trained model.
+
+  Args
+    cache_dir: string. directory where the cache entries are stored
+    subjects: list of numbers. The subjects the stats were computed on
+    actions: list of string. The actions the stats were computed on
+    one_hot: Whether the data has a one-hot encoding
+  Returns
+    stats: the tuple (data_mean, data_std, dimensions_to_ignore, dimensions_to_use)
+  Raises
+    IOError if there is no cache entry for these subjects, actions and one_hot
+  """
+  entry_dir = os.path.join( cache_dir, _cache_key(subjects, actions, one_hot) )
+  if _read_index( entry_dir ) is None:
+    raise IOError("No cache entry for subjects {0} in {1}, run with --preprocess first".format( list(subjects), cache_dir ))
+  return _read_stats( entry_dir )
+
+
+def check_stats( cache_dir, subjects, actions, one_hot ):
+  """
+  Check that the normalization stats of a cache entry are exactly np.mean and
+  np.std of the matrix with all the frames of the source files, as computed
+  by the SRNN code. The frames are read from the entry.
+
+  Args
+    cache_dir: string. directory where the cache entries are stored
+    subjects: list of numbers. The subjects the stats were computed on
+    actions: list of string. The actions the stats were computed on
+    one_hot: Whether the data has a one-hot encoding
+  Raises
+    AssertionError if the stats differ
+  """
+  entry_dir = os.path.join( cache_dir, _cache_key(subjects, actions, one_hot) )
+  completeData = np.load( os.path.join(entry_dir, 'frames.npy'), mmap_mode='r' )
+  data_mean, data_std, dim_to_ignore, dim_to_use = _read_stats( entry_dir )
+
+  expected_mean = np.mean( completeData, axis=0 )
+  expected_std  = np.std( completeData, axis=0 )
+  assert dim_to_use == list( np.where(expected_std >= 1e-4)[0] ), "dimensions_to_use differ"
+  expected_std[ expected_std < 1e-4 ] = 1.0
+  assert np.array_equal( data_mean, expected_mean ), "data_mean differs from np.mean"
+  assert np.array_equal( data_std, expected_std ), "data_std differs from np.std"
@@ -7,7 +7,8 @@ from __future__ import print_function
 
 import numpy as np
 from six.moves import xrange # pylint: disable=redefined-builtin
-import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 def rotmat2euler( R ):
   """
@@ -123,6 +124,140 @@ def expmap2rotmat(r):
   return R
 
 
+def rotmat2euler_batch( R ):
+  """
+  Batched version of rotmat2euler. Handles the gimbal lock special case per
+  matrix in exactly the same way as the scalar function.
+
+  Args
+    R: (..., 3, 3) array of rotation matrices
+  Returns
+    eul: (..., 3) array with the Euler angle representation of each R
+  """
+  R = np.asarray( R )
+
+  # special case: R[0,2] is exactly 1 or -1 (gimbal lock)
+  lock  = np.logical_or( R[...,0,2] == 1, R[...,0,2] == -1 )
+  E3    = np.zeros( R.shape[:-2] ) # set arbitrarily for the special case
+  dlta  = np.arctan2( R[...,0,1], R[...,0,2] )
+  E2_lk = np.where( R[...,0,2] == -1, np.pi/2, -np.pi/2 )
+  E1_lk = np.where( R[...,0,2] == -1, E3 + dlta, -E3 + dlta )
+
+  # general case, with the special case masked out to avoid dividing by zero
+  R02  = np.where( lock, 0, R[...,0,2] )
+  E2   = -np.arcsin( R02 )
+  cosE2 = np.cos( E2 )
+  E1   = np.arctan2( R[...,1,2]/cosE2, R[...,2,2]/cosE2 )
+  E3_g = np.arctan2( R[...,0,1]/cosE2, R[...,0,0]/cosE2 )
+
+  eul = np.stack([ np.where( lock, E1_lk, E1 ),
+                   np.where( lock, E2_lk, E2 ),
+                   np.where( lock, E3, E3_g ) ], axis=-1)
+  return eul
+
+
+def quat2expmap_batch(q):
+  """
+  Batched version of quat2expmap.
+
+  Args
+    q: (..., 4) array of quaternions
+  Returns
+    r: (..., 3) array of exponential maps
+  Raises
+    ValueError if the l2 norm of any quaternion is not close to 1
+  """
+  q = np.asarray( q )
+  if np.any( np.abs(np.linalg.norm(q, axis=-1)-1) > 1e-3 ):
+    raise ValueError("quat2expmap: input quaternion is not norm 1")
+
+  sinhalftheta = np.linalg.norm( q[...,1:], axis=-1 )
+  coshalftheta = q[...,0]
+
+  r0    = np.divide( q[...,1:], (sinhalftheta + np.finfo(np.float32).eps)[...,np.newaxis] )
+  theta = 2 * np.arctan2( sinhalftheta, coshalftheta )
+  theta = np.mod( theta + 2*np.pi, 2*np.pi )
+
+  flip  = theta > np.pi
+  theta = np.where( flip, 2 * np.pi - theta, theta )
+  r0    = np.where( flip[...,np.newaxis], -r0, r0 )
+
+  r = r0 * theta[...,np.newaxis]
+  return r
+
+
+def rotmat2quat_batch(R):
+  """
+  Batched version of rotmat2quat.
+
+  Args
+    R: (..., 3, 3) array of rotation matrices
+  Returns
+    q: (..., 4) array of quaternions
+  """
+  R = np.asarray( R )
+  rotdiff = R - np.swapaxes( R, -1, -2 )
+
+  r = np.stack([ -rotdiff[...,1,2], rotdiff[...,0,2], -rotdiff[...,0,1] ], axis=-1)
+  rnorm = np.linalg.norm( r, axis=-1 )
+  sintheta = rnorm / 2
+  r0 = np.divide( r, (rnorm + np.finfo(np.float32).eps)[...,np.newaxis] )
+
+  costheta = (np.trace( R, axis1=-2, axis2=-1 )-1) / 2
+
+  theta = np.arctan2( sintheta, costheta )
+
+  q = np.zeros( R.shape[:-2] + (4,) )
+  q[...,0]  = np.cos(theta/2)
+  q[...,1:] = r0*np.sin(theta/2)[...,np.newaxis]
+  return q
+
+
+def rotmat2expmap_batch(R):
+  return quat2expmap_batch( rotmat2quat_batch(R) )
+
+
+def expmap2rotmat_batch(r):
+  """
+  Batched version of expmap2rotmat (Rodrigues' formula).
+
+  Args
+    r: (..., 3) array of exponential maps
+  Returns
+    R: (..., 3, 3) array of rotation matrices
+  """
+  r = np.asarray( r )
+  theta = np.linalg.norm( r, axis=-1 )
+  r0  = np.divide( r, (theta + np.finfo(np.float32).eps)[...,np.newaxis] )
+
+  zeros = np.zeros( r.shape[:-1] )
+  r0x = np.stack([ zeros, -r0[...,2], r0[...,1],
+                   r0[...,2], zeros, -r0[...,0],
+                   -r0[...,1], r0[...,0], zeros ], axis=-1).reshape( r.shape[:-1] + (3,3) )
+
+  sin = np.sin(theta)[...,np.newaxis,np.newaxis]
+  cos = np.cos(theta)[...,np.newaxis,np.newaxis]
+  R = np.eye(3,3) + sin*r0x + (1-cos)*np.matmul( r0x, r0x )
+  return R
+
+
+def expmap2euler_channels(channels):
+  """
+  Converts the joint rotations of a batch of poses from exponential map to
+  Euler angles. The first 3 entries (global translation) are left untouched.
+
+  Args
+    channels: (..., 99) array of poses in exponential map format
+  Returns
+    eulerchannels: (..., 99) array of poses with the rotations in Euler angles
+  """
+  eulerchannels = np.array( channels )
+  expmaps = eulerchannels[..., 3:99].astype( float ).reshape( eulerchannels.shape[:-1] + (32, 3) )
+  eulerchannels[..., 3:99] = rotmat2euler_batch( expmap2rotmat_batch( expmaps ) ).reshape(
+    eulerchannels.shape[:-1] + (96,) )
+  return eulerchannels
+
+
 def unNormalizeData(normalizedData, data_mean, data_std, dimensions_to_ignore, actions, one_hot ):
   """Borrowed from SRNN code. Reads a csv file and returns a float32 matrix.
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/generateMotionData.py#L12
@@ -202,18 +337,35 @@ def readCSVasFloat(filename):
   Returns
     returnArray: the read data in a float32 matrix
   """
-  returnArray = []
-  lines = open(filename).readlines()
-  for line in lines:
-    line = line.strip().split(',')
-    if len(line) > 0:
-      returnArray.append(np.array([np.float32(x) for x in line]))
-
-  returnArray = np.array(returnArray)
+  # np.loadtxt parses the whole file in C, with the same float32 rounding as
+  # calling np.float32 on each value
+  returnArray = np.loadtxt(filename, delimiter=',', dtype=np.float32, ndmin=2)
   return returnArray
 
 
-def load_data(path_to_dataset, subjects, actions, one_hot):
+def read_csv_files(filenames, num_workers=None):
+  """
+  Reads several csv files with readCSVasFloat, in parallel.
+
+  Args
+    filenames: list of strings. Paths to the csv files
+    num_workers: number of processes to use. None uses one per core, and 0 or 1
+      reads the files in the calling process
+  Returns
+    arrays: list with the float32 matrix of each file, in the order of filenames
+  """
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  num_workers = min( num_workers, len(filenames) )
+
+  if num_workers <= 1:
+    return [readCSVasFloat(filename) for filename in filenames]
+
+  with ProcessPoolExecutor( max_workers=num_workers ) as executor:
+    return list( executor.map(readCSVasFloat, filenames) )
+
+
+def load_data(path_to_dataset, subjects, actions, one_hot, num_workers=None):
   """
   Borrowed from SRNN code. This is how the SRNN code reads the provided .txt files
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/processdata.py#L270
@@ -223,44 +375,43 @@ def load_data(path_to_dataset, subjects, actions, one_hot):
     subjects: list of numbers. The subjects to load
     actions: list of string. The actions to load
     one_hot: Whether to add a one-hot encoding to the data
+    num_workers: number of processes used to parse the files, see read_csv_files
   Returns
     trainData: dictionary with k:v
       k=(subject, action, subaction, 'even'), v=(nxd) un-normalized data
-    completeData: nxd matrix with all the data. Used to normlization stats
+    completeData: list with the nxd frames of each file, the blocks of the
+      matrix of all the data. Used to normlization stats
   """
   nactions = len( actions )
 
-  trainData = {}
-  completeData = []
+  files = []
   for subj in subjects:
     for action_idx in np.arange(len(actions)):
-
-      action = actions[ action_idx ]
-
       for subact in [1, 2]:  # subactions
+        filename = '{0}/S{1}/{2}_{3}.txt'.format( path_to_dataset, subj, actions[ action_idx ], subact)
+        files.append( (subj, action_idx, subact, filename) )
 
-        print("Reading subject {0}, action {1}, subaction {2}".format(subj, action, subact))
-
-        filename = '{0}/S{1}/{2}_{3}.txt'.format( path_to_dataset, subj, action, subact)
-        action_sequence = readCSVasFloat(filename)
-
-        n, d = action_sequence.shape
-        even_list = range(0, n, 2)
-
-        if one_hot:
-          # Add a one-hot encoding at the end of the representation
-          the_sequence = np.zeros( (len(even_list), d + nactions), dtype=float )
-          the_sequence[ :, 0:d ] = action_sequence[even_list, :]
-          the_sequence[ :, d+action_idx ] = 1
-          trainData[(subj, action, subact, 'even')] = the_sequence
-        else:
-          trainData[(subj, action, subact, 'even')] = action_sequence[even_list, :]
+  print("Reading {0} files".format( len(files) ))
+  action_sequences = read_csv_files( [f[3] for f in files], num_workers )
 
+  trainData = {}
+  completeData = []
+  for (subj, action_idx, subact, _), action_sequence in zip( files, action_sequences ):
+    action = actions[ action_idx ]
+
+    n, d = action_sequence.shape
+    even_list = range(0, n, 2)
+
+    if one_hot:
+      # Add a one-hot encoding at the end of the representation
+      the_sequence = np.zeros( (len(even_list), d + nactions), dtype=float )
+      the_sequence[ :, 0:d ] = action_sequence[even_list, :]
+      the_sequence[ :, d+action_idx ] = 1
+      trainData[(subj, action, subact, 'even')] = the_sequence
+    else:
+      trainData[(subj, action, subact, 'even')] = action_sequence[even_list, :]
 
-        if len(completeData) == 0:
-          completeData = copy.deepcopy(action_sequence)
-        else:
-          completeData = np.append(completeData, action_sequence, axis=0)
+    completeData.append( action_sequence )
 
   return trainData, completeData
 
@@ -299,21 +450,67 @@ def normalize_data( data, data_mean, data_std, dim_to_use, actions, one_hot ):
   return data_out
 
 
+def _sum_rows( total, block ):
+  """
+  Add the rows of a block to a running sum one after the other, in the order
+  np.sum(..., axis=0) adds the rows of a single matrix
+  """
+  if total is None:
+    return np.add.reduce( block, axis=0 )
+  return np.add.reduce( np.concatenate((total[np.newaxis], block)), axis=0 )
+
+
+def blockwise_mean_std( blocks ):
+  """
+  Mean and standard deviation of the rows of a matrix given as a list of
+  blocks, without concatenating them. Each block is read twice, one at a time.
+  The sums are accumulated in the dtype of the blocks and in the same order as
+  np.mean and np.std over the concatenated matrix, so the results are exactly
+  the same.
+
+  Args
+    blocks: list of nxd matrices, e.g. the frames of each file
+  Returns
+    mean: d-long vector
+    std: d-long vector
+  """
+  total, count = None, 0
+  for block in blocks:
+    total = _sum_rows( total, np.asarray(block) )
+    count += block.shape[0]
+
+  # Same divisions as np.mean and np.std, by the count as a numpy integer
+  count = np.intp( count )
+  mean = np.true_divide( total, count, out=total, casting='unsafe' )
+
+  squares = None
+  for block in blocks:
+    deviation = np.asarray( block ) - mean
+    squares = _sum_rows( squares, np.multiply(deviation, deviation, out=deviation) )
+
+  var = np.true_divide( squares, count, out=squares, casting='unsafe' )
+  return mean, np.sqrt( var, out=var )
+
+
 def normalization_stats(completeData):
   """"
   Also borrowed for SRNN code. Computes mean, stdev and dimensions to ignore.
   https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/processdata.py#L33
 
   Args
-    completeData: nx99 matrix with data to normalize
+    completeData: nx99 matrix with data to normalize, or the list of nx99 blocks
+      it is made of, which gives exactly the same stats (see blockwise_mean_std)
   Returns
     data_mean: vector of mean used to normalize the data
     data_std: vector of standard deviation used to normalize the data
     dimensions_to_ignore: vector with dimensions not used by the model
     dimensions_to_use: vector with dimensions used by the model
   """
-  data_mean = np.mean(completeData, axis=0)
-  data_std  =  np.std(completeData, axis=0)
+  if isinstance(completeData, list):
+    data_mean, data_std = blockwise_mean_std(completeData)
+  else:
+    data_mean = np.mean(completeData, axis=0)
+    data_std  =  np.std(completeData, axis=0)
 
   dimensions_to_ignore = []
   dimensions_to_use    = []
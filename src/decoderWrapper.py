@@ -8,6 +8,37 @@ import torch
 import torch.nn as nn
 from helper import *
 
+def gru_step(cell, input, state):
+    """
+    Run a single timestep of a (possibly multi-layer) nn.GRU with the fused GRU
+    cell kernel, which skips the sequence machinery of nn.GRU. The result is
+    the same as calling cell(input, state) on a length-1 sequence.
+
+    Args
+      cell: the nn.GRU to step. Other modules (e.g. a quantized GRU) are
+        simply called on the frame.
+      input: 1 * batch * input_size frame
+      state: num_layers * batch * rnn_size hidden state
+    Returns
+      output: 1 * batch * rnn_size output of the top layer
+      state: the new hidden state
+    """
+    if type(cell) is not nn.GRU or cell.bidirectional or cell.batch_first or (cell.dropout > 0 and cell.training):
+        return cell(input, state)
+
+    if state is None:
+        state = input.new_zeros(cell.num_layers, input.shape[1], cell.hidden_size)
+
+    x = input[0]
+    new_state = []
+    for layer in xrange(cell.num_layers):
+        suffix = '_l{0}'.format(layer)
+        x = torch.gru_cell(x, state[layer],
+                           getattr(cell, 'weight_ih' + suffix), getattr(cell, 'weight_hh' + suffix),
+                           getattr(cell, 'bias_ih' + suffix, None), getattr(cell, 'bias_hh' + suffix, None))
+        new_state.append(x)
+    return x.unsqueeze(0), torch.stack(new_state)
+
 class DecoderWrapper(nn.Module):
     def __init__(self,
                  cell,
@@ -30,12 +61,28 @@ class DecoderWrapper(nn.Module):
         torch.nn.init.uniform_(self.linear.weight, -0.04 , 0.04)
 
     def forward(self,input,state):
-        output = torch.zeros(self.target_seq_len,input.shape[1], input.shape[2] ,requires_grad=False, dtype=self.dtype).to(self.device)
+        # Every frame keeps the trailing (one-hot) entries of the input, so they
+        # are written once and only the predicted part is filled in the loop
+        output = input.new_empty(self.target_seq_len, input.shape[1], input.shape[2])
+        output[:,:,self.output_size:] = input[:,:,self.output_size:]
         for i in xrange(self.target_seq_len):
-            temp, state = self._cell(input, state)
-            new_frame = input.clone()
-            new_frame[:,:,:self.output_size] = self.linear(temp) + input[:,:,:self.output_size] if self.residual else self.linear(temp)
-            output[i] = new_frame
+            temp, state = gru_step(self._cell, input, state)
+            output[i,:,:self.output_size] = self.linear(temp[0]) + input[0,:,:self.output_size] if self.residual else self.linear(temp[0])
+        return output, state
+
+    def teacher_forced(self, inputs, state):
+        """
+        Decode all the steps at once, feeding the ground truth frames as inputs
+        (supervised loss). The cell runs once over the whole sequence, followed
+        by a single batched linear layer.
+
+        Args
+          inputs: seq * batch * input_size ground truth inputs of the decoder
+          state: initial hidden state of the decoder
+        """
+        temp, state = self._cell(inputs, state)
+        prediction = self.linear(temp) + inputs[:,:,:self.output_size] if self.residual else self.linear(temp)
+        output = torch.cat([prediction, inputs[:,:,self.output_size:]], 2)
         return output, state
 
 # Mean and std are seq * batch * 54 , sample is seq * batch * input_size
@@ -74,18 +121,47 @@ class StochasticDecoderWrapper(nn.Module):
                 nn.init.uniform_(m.weight, -0.05, 0.05)
 
 
-    def forward(self, input, state):
-        output_mean = torch.zeros(self.target_seq_len,input.shape[1], self.output_size ,requires_grad=False, dtype=self.dtype).to(self.device)
-        output_std = torch.zeros(self.target_seq_len,input.shape[1], self.output_size ,requires_grad=False, dtype=self.dtype).to(self.device)
-        output_sample = torch.zeros(self.target_seq_len,input.shape[1], input.shape[2] ,requires_grad=False, dtype=self.dtype).to(self.device)
+    def forward(self, input, state, generator=None):
+        """
+        Args
+          input: 1 * batch * input_size frame to start decoding from
+          state: initial hidden state of the decoder
+          generator: optional torch.Generator on the device of the model, to
+            draw the noise from. Uses the default generator if None.
+        """
+        output_mean = input.new_empty(self.target_seq_len, input.shape[1], self.output_size)
+        output_std = input.new_empty(self.target_seq_len, input.shape[1], self.output_size)
+        output_sample = input.new_empty(self.target_seq_len, input.shape[1], input.shape[2])
+        trailing = input[:,:,self.output_size:]
         for i in xrange(self.target_seq_len):
-            temp, state = self._cell(input, state)
+            temp, state = gru_step(self._cell, input, state)
             mean = self.mean(temp)
             std =  self.std(temp)
-            next_frame = input.clone()
-            next_frame[:,:,:self.output_size] = reparam_sample_gauss(mean, std) + input[:,:,:self.output_size] if self.residual else reparam_sample_gauss(mean, std)
-            output_mean[i] = mean
-            output_std[i] = std
-            output_sample[i] = next_frame
+            sample = reparam_sample_gauss(mean, std, generator)
+            # The next frame is a new tensor rather than a view of output_sample,
+            # since the cell keeps it for the backward pass
+            next_frame = torch.cat([sample + input[:,:,:self.output_size] if self.residual else sample, trailing], 2)
+            output_mean[i] = mean[0]
+            output_std[i] = std[0]
+            output_sample[i] = next_frame[0]
             input = next_frame
         return output_mean, output_std, output_sample, state
+
+    def teacher_forced(self, inputs, state, generator=None):
+        """
+        Decode all the steps at once, feeding the ground truth frames as inputs
+        (supervised loss). The cell runs once over the whole sequence, followed
+        by a single batched pass of the mean and std layers.
+
+        Args
+          inputs: seq * batch * input_size ground truth inputs of the decoder
+          state: initial hidden state of the decoder
+          generator: optional torch.Generator to draw the noise from
+        """
+        temp, state = self._cell(inputs, state)
+        mean = self.mean(temp)
+        std = self.std(temp)
+        sample = reparam_sample_gauss(mean, std, generator)
+        output_sample = torch.cat([sample + inputs[:,:,:self.output_size] if self.residual else sample,
+                                   inputs[:,:,self.output_size:]], 2)
+        return mean, std, output_sample, state
@@ -0,0 +1,248 @@
+"""Evaluation on srnn's seeds of all the actions in a single batch.
+
+Instead of one forward pass of 8 sequences per action, the seeds of all the
+actions are stacked action-major into one batch of 8 * len(actions)
+sequences. The model runs once, the whole batch is denormalized and
+converted to Euler angles at once, and the errors are split back per action.
+
+The seeds, model inputs and ground truths are prepared once per dataset as
+SRNNFixtures, which are cached on disk next to the dataset cache and kept on
+the device of the model.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+import data_utils
+import forward_kinematics
+import torch_utils
+
+SEEDS_PER_ACTION = 8  # we always evaluate 8 seeds
+FIXTURES_VERSION = 2
+
+def srnn_batch( model, test_set, actions ):
+  """
+  Stack srnn's seeds of several actions into a single batch.
+
+  Args
+    model: the Seq2SeqModel, whose get_batch_srnn gives the seeds of an action
+    test_set: dictionary with normalized test data
+    actions: list of actions
+  Returns
+    The tuple (encoder_inputs, decoder_inputs, decoder_outputs) of
+    (8 * len(actions), seq_len, input_size) arrays. The seeds of actions[i]
+    are in rows 8*i to 8*i+7.
+  """
+  batches = [model.get_batch_srnn( test_set, action ) for action in actions]
+  return tuple( np.concatenate( inputs, axis=0 ) for inputs in zip( *batches ) )
+
+
+def srnn_errors( srnn_poses, gts_euler, data_mean, data_std, dim_to_use, one_hot, number_of_actions ):
+  """
+  Per-action Euler angle errors of the predictions for a stacked batch of seeds.
+
+  Args
+    srnn_poses: seq_length_out * (8 * n) * input_size tensor with the normalized
+      predictions of the model for the batch of srnn_batch
+    gts_euler: (8 * n, seq_length_out, 99) tensor with the ground truths in Euler angles
+    data_mean: d-long tensor with the mean of the training data
+    data_std: d-long tensor with the standard deviation of the training data
+    dim_to_use: tensor with the dimensions used by the model
+    one_hot: whether the data comes with one-hot encoding
+    number_of_actions: length of the one-hot encoding
+  Returns
+    mean_mean_errors: (n, seq_length_out) tensor with the error of each action
+      at each frame, averaged over its 8 seeds
+  """
+  # Denormalize the output
+  srnn_pred_expmap = torch_utils.revert_output_format( srnn_poses,
+    data_mean, data_std, dim_to_use, one_hot, number_of_actions )
+
+  # Training is done in exponential map, but the error is reported in
+  # Euler angles, as in previous work.
+  # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-247769197
+  srnn_pred_euler = torch_utils.expmap2euler_channels( srnn_pred_expmap )
+
+  # The global translation (first 3 entries) and global rotation
+  # (next 3 entries) are also not considered in the error.
+  # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-249404882
+  mean_errors = torch_utils.euler_error( srnn_pred_euler, gts_euler )
+
+  # This is simply the mean error over the N_SEQUENCE_TEST examples of each action
+  mean_errors = mean_errors.view( -1, SEEDS_PER_ACTION, mean_errors.shape[1] )
+  return torch.mean( mean_errors, 1 )
+
+
+def body_pose( expmap ):
+  """Zero the global translation and rotation (first 6 entries) of poses, for their 3d points to be root-relative"""
+  if isinstance( expmap, torch.Tensor ):
+    return torch.cat( [torch.zeros_like(expmap[..., :6]), expmap[..., 6:]], dim=-1 )
+  expmap = np.array( expmap )
+  expmap[..., :6] = 0
+  return expmap
+
+
+def srnn_mpjpe( srnn_poses, gts_xyz, data_mean, data_std, dim_to_use, one_hot, number_of_actions, fk ):
+  """
+  Per-action mean per joint position error of the predictions for a stacked
+  batch of seeds, in millimeters. The 3d points of the 32 joints are relative
+  to the root, so the global translation and rotation do not count.
+
+  Args
+    srnn_poses, data_mean, data_std, dim_to_use, one_hot, number_of_actions: see srnn_errors
+    gts_xyz: (8 * n, seq_length_out, 96) tensor with the root-relative 3d points of the ground truths
+    fk: torch_utils.ForwardKinematics on the device of the tensors
+  Returns
+    mean_mpjpe: (n, seq_length_out) tensor with the error of each action
+      at each frame, averaged over its 8 seeds
+  """
+  srnn_pred_expmap = torch_utils.revert_output_format( srnn_poses,
+    data_mean, data_std, dim_to_use, one_hot, number_of_actions )
+  errors = torch_utils.mpjpe( fk( body_pose(srnn_pred_expmap) ), gts_xyz )
+  return torch.mean( errors.view( -1, SEEDS_PER_ACTION, errors.shape[1] ), 1 )
+
+
+class SRNNFixtures(object):
+  def __init__(self, actions, seeds, encoder_inputs, decoder_inputs, decoder_outputs,
+               gts_expmap, gts_euler, gts_xyz, data_mean, data_std, dim_to_use, device=None):
+    """
+    Everything needed to evaluate a model on srnn's seeds of several actions.
+    The arrays are stacked action-major as in srnn_batch, the seeds of
+    actions[i] are in rows 8*i to 8*i+7 (see rows).
+
+    Attributes
+      actions: list of the actions
+      seeds: (8 * n, 2) array with the subaction and frame of each seed
+      encoder_inputs: (source_seq_len-1) * (8 * n) * input_size float32 tensor, on the device
+      decoder_inputs: seq_length_out * (8 * n) * input_size float32 tensor, on the device
+      decoder_outputs: seq_length_out * (8 * n) * input_size float32 tensor, on the device
+      gts_expmap: (8 * n, seq_length_out, 99) array with the denormalized ground truths
+      gts_euler: the same ground truths in Euler angles
+      gts_euler_t: gts_euler as a float64 tensor on the device
+      gts_xyz: (8 * n, seq_length_out, 96) float64 tensor on the device with
+        the root-relative 3d points of the ground truths
+      fk: torch_utils.ForwardKinematics on the device
+      data_mean, data_std: d-long float64 tensors with the normalization stats, on the device
+      dim_to_use: tensor with the dimensions used by the model, on the device
+    """
+    self.actions = list( actions )
+    self.seeds = seeds
+    self.gts_expmap = gts_expmap
+    self.gts_euler = gts_euler
+
+    # Time-major float32, as fed to the model
+    to_device = lambda x: torch.from_numpy( np.ascontiguousarray(np.transpose(x, (1, 0, 2)), dtype=np.float32) ).to( device )
+    self.encoder_inputs  = to_device( encoder_inputs )
+    self.decoder_inputs  = to_device( decoder_inputs )
+    self.decoder_outputs = to_device( decoder_outputs )
+    self.gts_euler_t = torch.tensor( gts_euler, dtype=torch.float64, device=device )
+    self.gts_xyz = torch.tensor( gts_xyz, dtype=torch.float64, device=device )
+    self.fk = torch_utils.ForwardKinematics( *forward_kinematics._some_variables(), device=device )
+    self.data_mean = torch.tensor( data_mean, dtype=torch.float64, device=device )
+    self.data_std  = torch.tensor( data_std, dtype=torch.float64, device=device )
+    self.dim_to_use = torch.tensor( dim_to_use, dtype=torch.long, device=device )
+
+    self._arrays = {'seeds': seeds, 'encoder_inputs': encoder_inputs, 'decoder_inputs': decoder_inputs,
+                    'decoder_outputs': decoder_outputs, 'gts_expmap': gts_expmap, 'gts_euler': gts_euler,
+                    'gts_xyz': gts_xyz, 'data_mean': data_mean, 'data_std': data_std, 'dim_to_use': np.asarray( dim_to_use )}
+
+  def rows(self, action):
+    """Slice of the rows (or batch columns of the tensors) with the seeds of an action"""
+    start = self.actions.index( action ) * SEEDS_PER_ACTION
+    return slice( start, start + SEEDS_PER_ACTION )
+
+  @classmethod
+  def build(cls, model, test_set, actions, data_mean, data_std, dim_to_use, one_hot, device=None):
+    """
+    Prepare the fixtures of a dataset.
+
+    Args
+      model: a Seq2SeqModel, whose sequence lengths and get_batch_srnn are used
+      test_set: dictionary with normalized test data
+      actions: list of actions to evaluate on
+      data_mean: d-long vector with the mean of the training data
+      data_std: d-long vector with the standard deviation of the training data
+      dim_to_use: dimensions that are used by the model
+      one_hot: whether the data comes with one-hot encoding
+      device: device to keep the tensors on
+    """
+    seeds = []
+    for action in actions:
+      frames = model.find_indices_srnn( test_set, action )
+      seeds.extend( [((i % 2) + 1, frames[i]) for i in range(SEEDS_PER_ACTION)] )
+    seeds = np.array( seeds, dtype=np.int64 )
+
+    # The normalized data is float32, so the inputs are stored with that precision
+    encoder_inputs, decoder_inputs, decoder_outputs = [inputs.astype( np.float32 )
+                                                       for inputs in srnn_batch( model, test_set, actions )]
+
+    # Denormalize the expected outputs, like data_utils.unNormalizeData
+    gts_expmap = np.zeros( decoder_outputs.shape[:2] + (data_mean.shape[0],), dtype=np.float32 )
+    gts_expmap[:, :, dim_to_use] = decoder_outputs[:, :, :-len(actions)] if one_hot else decoder_outputs
+    gts_expmap = gts_expmap * data_std + data_mean
+
+    # expmap -> rotmat -> euler
+    gts_euler = data_utils.expmap2euler_channels( gts_expmap )
+    gts_xyz = forward_kinematics.fkl_batch( body_pose(gts_expmap), *forward_kinematics._some_variables() )
+
+    return cls( actions, seeds, encoder_inputs, decoder_inputs, decoder_outputs,
+                gts_expmap, gts_euler, gts_xyz, data_mean, data_std, dim_to_use, device )
+
+  def save(self, path):
+    """Save the fixtures to an .npz file"""
+    tmp = '{0}.tmp{1}.npz'.format( path, os.getpid() )
+    np.savez( tmp, actions=np.array(self.actions), **self._arrays )
+    os.replace( tmp, path )
+
+  @classmethod
+  def load(cls, path, device=None):
+    """Load fixtures saved with save, to the given device"""
+    with np.load( path ) as f:
+      arrays = dict( f )
+    return cls( arrays.pop('actions').tolist(), device=device, **arrays )
+
+
+def _fixtures_key( model, test_set, actions, data_mean, data_std, one_hot ):
+  """Digest of everything the fixtures depend on"""
+  sha = hashlib.sha1()
+  sha.update( json.dumps({'version': FIXTURES_VERSION, 'actions': list(actions), 'one_hot': bool(one_hot),
+                          'source_seq_len': model.source_seq_len, 'target_seq_len': model.target_seq_len}).encode('utf-8') )
+  for stat in (data_mean, data_std):
+    sha.update( np.ascontiguousarray(stat, dtype=np.float32).tobytes() )
+  # The seeds come from subject 5
+  for action in actions:
+    for subaction in [1, 2]:
+      sha.update( np.ascontiguousarray(test_set[(5, action, subaction, 'even')], dtype=np.float32).tobytes() )
+  return sha.hexdigest()[:16]
+
+
+def load_fixtures( model, test_set, actions, data_mean, data_std, dim_to_use, one_hot, cache_dir=None, device=None ):
+  """
+  Fixtures of a dataset, read from cache_dir if they were already prepared,
+  or else built and saved there. See SRNNFixtures.build for the arguments.
+
+  Args
+    cache_dir: directory of the dataset cache. The fixtures are not cached if None.
+  """
+  if not cache_dir:
+    return SRNNFixtures.build( model, test_set, actions, data_mean, data_std, dim_to_use, one_hot, device )
+
+  path = os.path.join( cache_dir, 'srnn_fixtures',
+                       _fixtures_key(model, test_set, actions, data_mean, data_std, one_hot) + '.npz' )
+  if os.path.isfile( path ):
+    return SRNNFixtures.load( path, device )
+
+  fixtures = SRNNFixtures.build( model, test_set, actions, data_mean, data_std, dim_to_use, one_hot, device )
+  if not os.path.isdir( os.path.dirname(path) ):
+    os.makedirs( os.path.dirname(path) )
+  fixtures.save( path )
+  print("Cached srnn's seeds in {0}".format( path ))
+  return fixtures
@@ -2,22 +2,18 @@ from __future__ import division
 
 import numpy as np
 import h5py
-import matplotlib
-import matplotlib.pyplot as plt
-import matplotlib.animation as animation
-from mpl_toolkits.mplot3d import Axes3D
-import viz
 import time
 import copy
 import data_utils
 import argparse
 
-parser = argparse.ArgumentParser(description="Human Motion Model")
-parser.add_argument('--sample_name', default='samples.h5', type=str, metavar='S', help='input sample file.')
-parser.add_argument('--action_name', default='walking_0', type=str, metavar='S', help='input action.')
-parser.add_argument('--save_name', default='walking_0.gif', type=str, metavar='S', help='input file name')
-parser.add_argument('--save', action='store_true', help="Whether to save the gif")
-args = parser.parse_args()
+def parse_args( argv=None ):
+  parser = argparse.ArgumentParser(description="Human Motion Model")
+  parser.add_argument('--sample_name', default='samples.h5', type=str, metavar='S', help='input sample file.')
+  parser.add_argument('--action_name', default='walking_0', type=str, metavar='S', help='input action.')
+  parser.add_argument('--save_name', default='walking_0.gif', type=str, metavar='S', help='input file name')
+  parser.add_argument('--save', action='store_true', help="Whether to save the gif")
+  return parser.parse_args( argv )
 
 def fkl( angles, parent, offset, rotInd, expmapInd ):
   """
@@ -70,41 +66,129 @@ def fkl( angles, parent, offset, rotInd, expmapInd ):
 
   return np.reshape( xyz, [-1] )
 
+def kinematic_levels( parent ):
+  """
+  Group the joints of the kinematic tree by depth, so that the joints of a
+  level only depend on the joints of the previous levels.
+
+  Args
+    parent: 32-long vector with parent-child relationships in the kinematic tree
+  Returns
+    levels: list with the array of joint indices at each depth, the root first
+  """
+  depth = np.zeros( len(parent), dtype=int )
+  for i in range( len(parent) ):
+    # Parents always come before their children
+    depth[i] = 0 if parent[i] == -1 else depth[ parent[i] ] + 1
+  return [np.where( depth == d )[0] for d in range( depth.max()+1 )]
+
+def position_indices( rotInd ):
+  """
+  Indices of the 3d position of each joint into a 99-long vector of angles.
+  Joints without a position get index 99, to be read from a padding of zeros.
+
+  Args
+    rotInd: 32-long list with indices into angles
+  Returns
+    posInd: 32x3 array of indices
+  """
+  return np.array([ np.array(ind)-1 if ind else [99, 99, 99] for ind in rotInd ])
+
+def fkl_batch( angles, parent, offset, rotInd, expmapInd, levels=None ):
+  """
+  Batched version of fkl, for whole sequences of poses. All the joints at the
+  same depth of the kinematic tree are transformed together.
+
+  Args
+    angles: (..., 99) array with 3d positions and 3d joint angles in expmap format
+    parent, offset, rotInd, expmapInd: the kinematic tree, see _some_variables
+    levels: kinematic_levels of parent, computed if None
+  Returns
+    xyz: (..., 96) array with the 32 3d points of each pose
+  """
+  angles = np.asarray( angles, dtype=float )
+  assert angles.shape[-1] == 99
+  if levels is None:
+    levels = kinematic_levels( parent )
+
+  # Rotation and position of every joint with respect to its parent
+  padded = np.concatenate( [angles, np.zeros( angles.shape[:-1] + (1,) )], axis=-1 )
+  positions = offset + padded[..., position_indices(rotInd)]
+  rotations = data_utils.expmap2rotmat_batch( angles[..., np.array(expmapInd)] )
+
+  xyz = np.zeros( angles.shape[:-1] + (len(parent), 3) )
+  for level in levels:
+    p = parent[level]
+    if p[0] == -1: # Root node
+      xyz[..., level, :] = positions[..., level, :]
+    else:
+      xyz[..., level, :] = np.matmul( positions[..., level, np.newaxis, :], rotations[..., p, :, :] )[..., 0, :] + xyz[..., p, :]
+      rotations[..., level, :, :] = np.matmul( rotations[..., level, :, :], rotations[..., p, :, :] )
+
+  xyz = xyz[..., [0,2,1]]
+  return np.reshape( xyz, angles.shape[:-1] + (-1,) )
+
 def revert_coordinate_space(channels, R0, T0):
   """
   Bring a series of poses to a canonical form so they are facing the camera when they start.
   Adapted from
   https://github.com/asheshjain399/RNNexp/blob/7fc5a53292dc0f232867beb66c3a9ef845d705cb/structural_rnn/CRFProblems/H3.6m/dataParser/Utils/revertCoordinateSpace.m
 
+  Several sequences can be passed at once. Only the composition of the root
+  rotations runs frame by frame, on the stacked rotations of all the sequences.
+
   Args
-    channels: n-by-99 matrix of poses
-    R0: 3x3 rotation for the first frame
-    T0: 1x3 position for the first frame
+    channels: n-by-99 matrix of poses, or (..., n, 99) array of sequences of poses
+    R0: 3x3 rotation for the first frame, or (..., 3, 3) rotations of each sequence
+    T0: 1x3 position for the first frame, or (..., 3) positions of each sequence
   Returns
     channels_rec: The passed poses, but the first has T0 and R0, and the
                   rest of the sequence is modified accordingly.
   """
-  n, d = channels.shape
-
-  channels_rec = copy.copy(channels)
-  R_prev = R0
-  T_prev = T0
+  channels_rec = np.array(channels)
+  n = channels_rec.shape[-2]
+  batch_shape = channels_rec.shape[:-2]
   rootRotInd = np.arange(3,6)
 
-  # Loop through the passed posses
+  R_diff = data_utils.expmap2rotmat_batch( channels_rec[..., rootRotInd] )
+  R_prev = np.broadcast_to( R0, batch_shape + (3,3) )
+
+  # Rotation of each frame, and of the previous one
+  R = np.zeros( batch_shape + (n,3,3) )
+  R_before = np.zeros( batch_shape + (n,3,3) )
   for ii in range(n):
-    R_diff = data_utils.expmap2rotmat( channels[ii, rootRotInd] )
-    R = R_diff.dot( R_prev )
+    R_before[..., ii, :, :] = R_prev
+    R_prev = np.matmul( R_diff[..., ii, :, :], R_prev )
+    R[..., ii, :, :] = R_prev
 
-    channels_rec[ii, rootRotInd] = data_utils.rotmat2expmap(R)
-    T = T_prev + ((R_prev.T).dot( np.reshape(channels[ii,:3],[3,1]))).reshape(-1)
-    channels_rec[ii,:3] = T
-    T_prev = T
-    R_prev = R
+  # The translation of each frame is expressed in the rotation of the previous one
+  steps = np.matmul( np.swapaxes(R_before, -1, -2), channels_rec[..., :3, np.newaxis] )[..., 0]
+  T0 = np.broadcast_to( np.reshape(T0, 3) if not batch_shape else T0, batch_shape + (3,) )
+  channels_rec[..., :3] = T0[..., np.newaxis, :] + np.cumsum( steps, axis=-2 )
+  channels_rec[..., rootRotInd] = data_utils.rotmat2expmap_batch( R )
 
   return channels_rec
 
 
+def canonical_xyz( expmap_gt, expmap_pred ):
+  """
+  3d points of ground truths followed by predictions, as they are visualized:
+  each gt and its prediction are reverted to the coordinate space of the
+  first gt frame together, so that the prediction continues from the gt.
+
+  Args
+    expmap_gt: (..., n_gt, 99) array with the ground truth sequences in expmap format
+    expmap_pred: (..., n_pred, 99) array with the predicted sequences
+  Returns
+    xyz_gt: (..., n_gt, 96) array with the 3d points of the ground truths
+    xyz_pred: (..., n_pred, 96) array with the 3d points of the predictions
+  """
+  nframes_gt = np.shape(expmap_gt)[-2]
+  expmap_all = revert_coordinate_space( np.concatenate((expmap_gt, expmap_pred), axis=-2), np.eye(3), np.zeros(3) )
+  xyz_all = fkl_batch( expmap_all, *_some_variables() )
+  return xyz_all[..., :nframes_gt, :], xyz_all[..., nframes_gt:, :]
+
+
 def _some_variables():
   """
   We define some variables that are useful to run the kinematic tree
@@ -162,67 +246,25 @@ def _some_variables():
   return parent, offset, rotInd, expmapInd
 
 def main():
+  import matplotlib
+  import matplotlib.pyplot as plt
+  import matplotlib.animation as animation
+  from mpl_toolkits.mplot3d import Axes3D
+  import viz
 
-  # Load all the data
-  parent, offset, rotInd, expmapInd = _some_variables()
-
-  # numpy implementation
-  with h5py.File( args.sample_name, 'r' ) as h5f:
-    expmap_gt = h5f['expmap/gt/'+args.action_name][:]
-    expmap_pred = h5f['expmap/preds/'+args.action_name][:]
-
-
-  nframes_gt, nframes_pred = expmap_gt.shape[0], expmap_pred.shape[0]
-
-  # Put them together and revert the coordinate space
-  expmap_all = revert_coordinate_space( np.vstack((expmap_gt, expmap_pred)), np.eye(3), np.zeros(3) )
-  expmap_gt   = expmap_all[:nframes_gt,:]
-  expmap_pred = expmap_all[nframes_gt:,:]
+  args = parse_args()
 
-  # Compute 3d points for each frame
-  xyz_gt, xyz_pred = np.zeros((nframes_gt, 96)), np.zeros((nframes_pred, 96))
-  for i in range( nframes_gt ):
-    xyz_gt[i,:] = fkl( expmap_gt[i,:], parent, offset, rotInd, expmapInd )
-  for i in range( nframes_pred ):
-    xyz_pred[i,:] = fkl( expmap_pred[i,:], parent, offset, rotInd, expmapInd )
+  # The 3d points are saved with the samples, or else computed here
+  xyz_gt, xyz_pred = viz.load_xyz( args.sample_name, args.action_name )
 
   # === Plot and animate ===
   fig = plt.figure()
-  ax = plt.gca(projection='3d')
+  ax = fig.add_subplot(111, projection='3d')
   ob = viz.Ax3DPose(ax)
 
-  # Plot the conditioning ground truth
-  # for i in range(nframes_gt):
-  #   ob.update( xyz_gt[i,:] )
-  #   # plt.show(block=False)
-  #   # fig.canvas.draw()
-  #   plt.pause(0.01)
-  #
-  # # Plot the prediction
-  # for i in range(nframes_pred):
-  #   ob.update( xyz_pred[i,:], lcolor="#9b59b6", rcolor="#2ecc71" )
-  #   # plt.show(block=False)
-  #   # fig.canvas.draw()
-  #   plt.pause(0.01)
-  to_draw = np.append(xyz_gt, xyz_pred,axis=0)
-
-  # dirty workround for generation gif
-  counter = 0
-  def update(x):
-      nonlocal counter
-      if counter < 25:
-          counter += 1
-          return ob.update(x)
-      else:
-          if counter == 50:
-              counter = 0
-          else:
-              counter += 1
-          return ob.update(x,lcolor="#9b59b6", rcolor="#2ecc71")
-
-  anim = animation.FuncAnimation(fig, update, frames=to_draw, interval=40)
+  anim = viz.animate( fig, ob, xyz_gt, xyz_pred, fps=25 )
   if args.save:
-      anim.save(args.save_name,writer='imagemagick', fps=25)
+      anim.save(args.save_name, writer=animation.PillowWriter(fps=25))
   else:
       plt.show()
 
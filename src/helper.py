@@ -2,24 +2,43 @@ from torch import nn
 import torch
 import numpy as np
 
-# update the discriminator
-def update_discrim(dis_times, discrim_net, optimizer_discrim, discrim_criterion, expert_state, expert_action, state, action, device, start_idx, train=True):
-    expert_state = expert_state.detach()
-    expert_action = expert_action.detach()
-    state = state.detach()
-    action = action.detach()
+# constant tensors reused as the targets of the BCE losses, keyed on their shape, dtype, device and value
+_CONSTANTS = {}
+
+def constant_like(output, value):
+    key = (tuple(output.shape), output.dtype, output.device, value)
+    if key not in _CONSTANTS:
+        _CONSTANTS[key] = torch.full(output.shape, value, dtype=output.dtype, device=output.device)
+    return _CONSTANTS[key]
+
+# targets and weights of the fused discriminator loss, for n_gen generated then n_exp expert sequences of seq frames.
+# Each half is averaged separately, so the loss is the sum of the mean BCE of both halves for any n_gen and n_exp
+def fused_targets(seq, n_gen, n_exp, dtype, device):
+    key = ('fused', seq, n_gen, n_exp, dtype, device)
+    if key not in _CONSTANTS:
+        labels = torch.cat([torch.zeros(seq, n_gen, 1), torch.ones(seq, n_exp, 1)], 1)
+        weights = torch.cat([torch.full((seq, n_gen, 1), 1.0 / (seq * n_gen)),
+                             torch.full((seq, n_exp, 1), 1.0 / (seq * n_exp))], 1)
+        _CONSTANTS[key] = labels.to(device=device, dtype=dtype), weights.to(device=device, dtype=dtype)
+    return _CONSTANTS[key]
+
+# update the discriminator, with a single pass on the generated and expert sequences stacked along the batch.
+# Returns the mean output on the first num_fresh generated sequences (all if None) and on the expert ones, as tensors on the device
+def update_discrim(dis_times, discrim_net, optimizer_discrim, expert_state, expert_action, state, action, device, start_idx, train=True, num_fresh=None):
+    n_gen = state.shape[1]
+    fused_state = torch.cat([state.detach(), expert_state.detach()], 1)
+    fused_action = torch.cat([action.detach(), expert_action.detach()], 1)
     g_o_ave = 0.0
     e_o_ave = 0.0
     for _ in range(int(dis_times)):
-        g_o = discrim_net(state, action)[start_idx:,:,:]
-        e_o = discrim_net(expert_state, expert_action)[start_idx:,:,:]
-        g_o_ave += g_o.cpu().data.mean()
-        e_o_ave += e_o.cpu().data.mean()
+        o = discrim_net(fused_state, fused_action)[start_idx:,:,:]
+        g_o_ave += o[:, :n_gen][:, :num_fresh].detach().mean()
+        e_o_ave += o[:, n_gen:].detach().mean()
 
         if train:
             optimizer_discrim.zero_grad()
-            discrim_loss = discrim_criterion(g_o, torch.zeros(g_o.shape).to(device)) + \
-                           discrim_criterion(e_o, torch.ones(e_o.shape).to(device))
+            labels, weights = fused_targets(o.shape[0], n_gen, o.shape[1] - n_gen, o.dtype, o.device)
+            discrim_loss = nn.functional.binary_cross_entropy(o, labels, weight=weights, reduction='sum')
             discrim_loss.backward()
             optimizer_discrim.step()
 
@@ -30,11 +49,71 @@ def update_discrim(dis_times, discrim_net, optimizer_discrim, discrim_criterion,
 def update_policy(policy_net, optimizer_policy, discrim_net, discrim_criterion, state, action, start_idx, clip_grad_norm, device):
     g_o = discrim_net(state, action)[start_idx:, :, :]
     optimizer_policy.zero_grad()
-    policy_loss = discrim_criterion(g_o, torch.ones(g_o.shape).to(device))
+    policy_loss = discrim_criterion(g_o, constant_like(g_o, 1.0))
     policy_loss.backward()
     torch.nn.utils.clip_grad_norm_(policy_net.parameters(), clip_grad_norm)
     optimizer_policy.step()
 
+class ReplayBuffer(object):
+    def __init__(self, capacity, seed=None):
+        """
+        Ring buffer of the generated state/action sequences, so that the
+        discriminator also sees the rollouts of earlier policies.
+
+        Args
+          capacity: maximum number of sequences to keep
+          seed: seed of the random generator choosing the replayed sequences
+        """
+        self.capacity = capacity
+        self.rng = np.random.RandomState(seed)
+        self.state = None
+        self.action = None
+        self.size = 0
+        self.next_idx = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, state, action):
+        """Store the sequences of a seq * batch * dim batch, overwriting the oldest ones"""
+        if self.capacity <= 0:
+            return
+        n = min(state.shape[1], self.capacity)
+        state, action = state[:, -n:].detach(), action[:, -n:].detach()
+        if self.state is None:
+            self.state = state.new_empty((state.shape[0], self.capacity, state.shape[2]))
+            self.action = action.new_empty((action.shape[0], self.capacity, action.shape[2]))
+        idx = torch.arange(self.next_idx, self.next_idx + n, device=state.device) % self.capacity
+        self.state[:, idx] = state
+        self.action[:, idx] = action
+        self.next_idx = (self.next_idx + n) % self.capacity
+        self.size = min(self.size + n, self.capacity)
+
+    def sample(self, batch_size):
+        """Get batch_size stored sequences drawn at random, as seq * batch_size * dim tensors"""
+        idx = torch.from_numpy(self.rng.randint(0, self.size, batch_size)).to(self.state.device)
+        return self.state[:, idx], self.action[:, idx]
+
+    def mix(self, state, action, ratio):
+        """
+        Append replayed sequences to a batch of fresh ones, and store the fresh ones.
+
+        Args
+          state, action: seq * batch * dim tensors with the fresh rollouts
+          ratio: number of replayed sequences per fresh one
+        Returns
+          The tuple (state, action) with the fresh sequences first and then
+          the replayed ones, if the buffer has any.
+        """
+        num_replayed = min(int(round(ratio * state.shape[1])), self.size)
+        if num_replayed > 0:
+            replayed_state, replayed_action = self.sample(num_replayed)
+            mixed = torch.cat([state, replayed_state], 1), torch.cat([action, replayed_action], 1)
+        else:
+            mixed = state, action
+        self.push(state, action)
+        return mixed
+
 # get the state and action for training, the shape is seq * batch * dim
 def get_state_action(encoder_inputs, decoder_inputs, decoder_outputs):
     try:
@@ -57,11 +136,9 @@ def nll_gauss(mean, std, x):
     nll_element = (x - mean).pow(2) / std.pow(2) + 2*torch.log(std) + torch.log(2*pi)
     return 0.5 * torch.sum(nll_element)
 
-#Sampling a sequence to perform reparametrization trick
-def reparam_sample_gauss(mean, std):
-    eps = torch.FloatTensor(std.size()).normal_()
-    if mean.is_cuda:
-        eps = eps.cuda()
+#Sampling a sequence to perform reparametrization trick, the noise is drawn on the device of std
+def reparam_sample_gauss(mean, std, generator=None):
+    eps = torch.randn(std.size(), dtype=std.dtype, device=std.device, generator=generator)
     return eps.mul(std).add_(mean)
 
 # Given var and sampled result, get the mean
@@ -0,0 +1,175 @@
+"""Online motion prediction for live pose streams.
+
+Instead of encoding a whole window of frames for every prediction, the
+predictor keeps the encoder hidden state of each stream and advances it by a
+single GRU step when a new frame arrives. A forecast only runs the decoder,
+starting from the current state and the last received frame.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+import decoderWrapper
+import torch_utils
+
+class _Stream(object):
+    def __init__(self, action_idx):
+        self.action_idx = action_idx
+        self.state = None    # num_layers * 1 * rnn_size encoder state, None before the first step
+        self.pending = None  # input_size vector, last frame not encoded yet
+        self.num_frames = 0
+
+class OnlinePredictor(object):
+    def __init__(self, model, data_mean, data_std, dim_to_use, actions, device=None):
+        """
+        Online predictor built on a trained Seq2SeqModel.
+
+        Frames go in and out as raw 99-dim exponential maps, and are normalized
+        with the stats of the training data. The encoder state of a stream
+        summarizes all the frames received so far: once a stream has received
+        exactly source_seq_len frames, its forecast is the same as running the
+        model on that window.
+
+        Args
+          model: the trained Seq2SeqModel. It is put in eval mode.
+          data_mean: vector of mean used to normalize the data
+          data_std: vector of standard deviation used to normalize the data
+          dim_to_use: vector with dimensions used by the model
+          actions: list of strings with the encoded actions, as used for training
+          device: device to run on. Defaults to the device of the model.
+        """
+        self.model = model.eval()
+        self.device = device if device is not None else next(model.parameters()).device
+        self.actions = list(actions)
+        self.one_hot = model.input_size > model.HUMAN_SIZE
+
+        self.data_mean = torch.as_tensor(np.asarray(data_mean), dtype=torch.float32, device=self.device)
+        self.data_std = torch.as_tensor(np.asarray(data_std), dtype=torch.float32, device=self.device)
+        self.dim_to_use = torch.as_tensor(np.asarray(dim_to_use), dtype=torch.long, device=self.device)
+        self.streams = {}
+
+    def open_stream(self, stream_id, action=None):
+        """
+        Start a new stream, or restart an existing one from scratch.
+
+        Args
+          stream_id: any hashable key identifying the stream
+          action: the action of the stream, needed if the model uses one-hot encoding
+        """
+        if self.one_hot:
+            if action not in self.actions:
+                raise ValueError("Unrecognized action {0}".format(action))
+            action_idx = self.actions.index(action)
+        else:
+            action_idx = None
+        self.streams[stream_id] = _Stream(action_idx)
+
+    def close_stream(self, stream_id):
+        """Forget the state of a stream"""
+        del self.streams[stream_id]
+
+    def num_frames(self, stream_id):
+        """Number of frames received by a stream since it was opened"""
+        return self.streams[stream_id].num_frames
+
+    def _normalize(self, frames, streams):
+        """Normalize raw N * 99 frames into N * input_size model inputs"""
+        frames = torch.as_tensor(np.asarray(frames), dtype=torch.float32, device=self.device)
+        normalized = ((frames - self.data_mean) / self.data_std)[:, self.dim_to_use]
+        if self.one_hot:
+            one_hot = normalized.new_zeros(normalized.shape[0], len(self.actions))
+            one_hot[torch.arange(len(streams)), [s.action_idx for s in streams]] = 1
+            normalized = torch.cat([normalized, one_hot], 1)
+        return normalized
+
+    def _batch_state(self, streams):
+        """Stack the encoder states of some streams, zeros for the ones without state"""
+        model = self.model
+        zeros = None
+        states = []
+        for s in streams:
+            if s.state is None:
+                if zeros is None:
+                    zeros = torch.zeros(model.num_layers, 1, model.rnn_size, device=self.device)
+                states.append(zeros)
+            else:
+                states.append(s.state)
+        return torch.cat(states, 1)
+
+    def push_many(self, stream_ids, frames):
+        """
+        Add one new frame to each of several streams. The encoder takes a
+        single step for all of them together.
+
+        Args
+          stream_ids: list of distinct ids of open streams
+          frames: len(stream_ids) * 99 array with the new raw frames
+        """
+        if len(set(stream_ids)) != len(stream_ids):
+            raise ValueError("Each stream can only get one frame per push")
+        streams = [self.streams[stream_id] for stream_id in stream_ids]
+        normalized = self._normalize(frames, streams)
+
+        # The previous frame of each stream is encoded now, the new one is kept
+        # as the first input of the decoder
+        to_encode = [s for s in streams if s.pending is not None]
+        if to_encode:
+            with torch.no_grad():
+                _, state = decoderWrapper.gru_step(self.model.encoder,
+                                                   torch.stack([s.pending for s in to_encode], 0).unsqueeze(0),
+                                                   self._batch_state(to_encode))
+            for i, s in enumerate(to_encode):
+                s.state = state[:, i:i+1]
+
+        for i, s in enumerate(streams):
+            s.pending = normalized[i]
+            s.num_frames += 1
+
+    def push(self, stream_id, frame):
+        """
+        Add a new frame to a stream.
+
+        Args
+          stream_id: id of an open stream
+          frame: 99-long vector with the raw pose
+        """
+        self.push_many([stream_id], np.asarray(frame)[np.newaxis])
+
+    def forecast_many(self, stream_ids, generator=None):
+        """
+        Predict the next target_seq_len frames of several streams in a single
+        decoder pass. The state of the streams is not changed.
+
+        Args
+          stream_ids: list of ids of open streams with at least one frame
+          generator: optional torch.Generator to draw the noise of a stochastic decoder
+        Returns
+          poses: len(stream_ids) * target_seq_len * 99 array of raw predicted poses
+        """
+        streams = [self.streams[stream_id] for stream_id in stream_ids]
+        if any(s.pending is None for s in streams):
+            raise ValueError("Cannot forecast a stream that has not received any frame")
+
+        last_frame = torch.stack([s.pending for s in streams], 0).unsqueeze(0)
+        with torch.no_grad():
+            state = self._batch_state(streams)
+            if not self.model.stochastic:
+                output, _ = self.model.decoder(last_frame, state)
+            else:
+                _, _, output, _ = self.model.decoder(last_frame, state, generator)
+            poses = torch_utils.revert_output_format(output, self.data_mean, self.data_std, self.dim_to_use,
+                                                     self.one_hot, len(self.actions))
+        return poses.cpu().numpy()
+
+    def forecast(self, stream_id, generator=None):
+        """
+        Predict the next target_seq_len frames of a stream.
+
+        Returns
+          poses: target_seq_len * 99 array of raw predicted poses
+        """
+        return self.forecast_many([stream_id], generator)[0]
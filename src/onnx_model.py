@@ -0,0 +1,105 @@
+"""Export of a trained Seq2SeqModel to ONNX, and an onnxruntime backend to run it.
+
+The exported graph is the InferenceGraph of script_model traced for the
+target_seq_len of the model: the encoder and the unrolled decoding loop,
+residual velocities included, with a dynamic batch size. OnnxForecaster only
+needs numpy and onnxruntime, so the exported model runs without torch.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import numpy as np
+
+def export_onnx(model, path, opset_version=17):
+    """
+    Trace the inference path of a model and save it as ONNX. The shape of the
+    model is stored in the metadata of the file.
+
+    Args
+      model: the Seq2SeqModel to export, in eval mode
+      path: where to save the ONNX model
+      opset_version: ONNX opset to export to
+    """
+    import onnx
+    import torch
+    import script_model
+
+    graph = script_model.InferenceGraph(model).eval()
+    device = next(model.parameters()).device
+    encoder_input = torch.zeros(model.source_seq_len-1, 2, model.input_size, device=device)
+    decoder_input = torch.zeros(1, 2, model.input_size, device=device)
+    args = (encoder_input, decoder_input)
+    input_names = ['encoder_input', 'decoder_input']
+    dynamic_axes = {'encoder_input': {1: 'batch'},
+                    'decoder_input': {0: 'decoder_frames', 1: 'batch'},
+                    'output': {1: 'batch'}}
+    if model.stochastic:
+        # The noise is an input, so that runs can be reproduced and compared
+        args = args + (torch.zeros(model.target_seq_len, 2, model.HUMAN_SIZE, device=device),)
+        input_names.append('noise')
+        dynamic_axes['noise'] = {1: 'batch'}
+
+    with torch.no_grad():
+        torch.onnx.export(graph, args, path, dynamo=False, opset_version=opset_version,
+                          input_names=input_names, output_names=['output'], dynamic_axes=dynamic_axes)
+
+    proto = onnx.load(path)
+    metadata = {'source_seq_len': model.source_seq_len,
+                'target_seq_len': model.target_seq_len,
+                'input_size': model.input_size,
+                'output_size': model.HUMAN_SIZE,
+                'stochastic': model.stochastic,
+                'residual': model.decoder.residual}
+    for key, value in metadata.items():
+        entry = proto.metadata_props.add()
+        entry.key = key
+        entry.value = json.dumps(value)
+    onnx.save(proto, path)
+
+
+class OnnxForecaster(object):
+    def __init__(self, path, providers=None):
+        """
+        Run a model exported by export_onnx with onnxruntime.
+
+        Args
+          path: the exported ONNX model
+          providers: onnxruntime execution providers, all the available ones if None
+        """
+        try:
+            import onnxruntime
+        except ImportError:
+            raise ImportError("Running ONNX models needs onnxruntime (pip install onnxruntime)")
+
+        self.session = onnxruntime.InferenceSession(path, providers=providers or onnxruntime.get_available_providers())
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        self.source_seq_len = json.loads(metadata['source_seq_len'])
+        self.target_seq_len = json.loads(metadata['target_seq_len'])
+        self.input_size = json.loads(metadata['input_size'])
+        self.output_size = json.loads(metadata['output_size'])
+        self.stochastic = json.loads(metadata['stochastic'])
+        self.residual = json.loads(metadata['residual'])
+
+    def predict(self, encoder_input, decoder_input, noise=None, rng=np.random):
+        """
+        Args
+          encoder_input: (source_seq_len-1) * batch * input_size array
+          decoder_input: seq * batch * input_size array, only its first frame is used
+          noise: target_seq_len * batch * output_size standard normal noise of a
+            stochastic model. Drawn from rng if None.
+          rng: numpy RandomState (or np.random itself) to draw the noise from
+        Returns
+          output: target_seq_len * batch * input_size array with the predicted
+            frames (the samples for a stochastic model)
+        """
+        feed = {'encoder_input': np.ascontiguousarray(encoder_input, dtype=np.float32),
+                'decoder_input': np.ascontiguousarray(decoder_input[0:1], dtype=np.float32)}
+        if self.stochastic:
+            if noise is None:
+                noise = rng.standard_normal((self.target_seq_len, feed['encoder_input'].shape[1], self.output_size))
+            feed['noise'] = np.ascontiguousarray(noise, dtype=np.float32)
+        return self.session.run(['output'], feed)[0]
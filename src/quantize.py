@@ -0,0 +1,56 @@
+"""Post-training dynamic INT8 quantization of a Seq2SeqModel for CPU inference.
+
+The weights of the GRU cells and of the linear heads of the decoder are
+stored as int8, and the activations are quantized on the fly, so no
+calibration data is needed. Quantized models only run on the CPU.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import torch
+import torch.nn as nn
+
+QUANTIZED_MODULES = {nn.GRU, nn.Linear}
+
+def quantize_model(model):
+    """
+    Quantize the GRU and linear layers of a model in place. The model is moved
+    to the CPU and put in eval mode.
+
+    Args
+      model: a Seq2SeqModel, with fp32 weights
+    Returns
+      model: the same model, with dynamically quantized layers
+    """
+    model.cpu().eval()
+    tied = model.decoder._cell is model.encoder
+    torch.ao.quantization.quantize_dynamic(model, QUANTIZED_MODULES, dtype=torch.qint8, inplace=True)
+    # Each occurrence of a shared module is converted separately, so tie the
+    # decoder back to the encoder
+    if tied:
+        model.decoder._cell = model.encoder
+    return model
+
+
+def save_quantized(model, path):
+    """Save the state of a model returned by quantize_model"""
+    torch.save(model.state_dict(), path)
+
+
+def load_quantized(model, path):
+    """
+    Load a state saved by save_quantized.
+
+    Args
+      model: a freshly created Seq2SeqModel with the same architecture as the saved one
+      path: the saved quantized checkpoint
+    Returns
+      model: the model, quantized and with the saved weights
+    """
+    quantize_model(model)
+    # The packed int8 weights are not plain tensors, so the checkpoint cannot
+    # be read with weights_only
+    model.load_state_dict(torch.load(path, map_location='cpu', weights_only=False))
+    return model
@@ -0,0 +1,138 @@
+"""Render the samples of every action and seed to gif files, headless and in parallel.
+
+Each sequence is drawn with the Agg backend in its own process, and written
+with matplotlib's PillowWriter, so no display nor external binary (imagemagick,
+ffmpeg) is needed.
+
+  python src/render.py --sample_name samples.h5 --out_dir figs
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.animation as animation
+import h5py
+
+import sample_store
+import viz
+
+def list_sequences( sample_name ):
+  """
+  Names of the sequences in a file of samples, in the order they were written.
+
+  Args
+    sample_name: h5 file written by translate.py --sample, in either format
+  Returns
+    names: list of names such as walking_0, to pass to viz.load_xyz
+  """
+  if sample_store.is_store( sample_name ):
+    with sample_store.SampleReader( sample_name ) as reader:
+      return ["{0}_{1}".format( action, seed ) for action, seed in reader.index]
+
+  with h5py.File( sample_name, 'r' ) as h5f:
+    names = list( h5f['expmap/gt'].keys() )
+  # Sort on the action, then on the seed as a number
+  return sorted( names, key=lambda name: (name.rsplit('_', 1)[0], int(name.rsplit('_', 1)[1])) )
+
+
+def render_sequence( sample_name, action_name, save_name, fps=25 ):
+  """
+  Render the ground truth of a sequence followed by its prediction to a gif.
+
+  Args
+    sample_name: h5 file written by translate.py --sample
+    action_name: name of the sequence, e.g. walking_0
+    save_name: gif file to write
+    fps: frames per second
+  Returns
+    save_name: the file written
+  """
+  xyz_gt, xyz_pred = viz.load_xyz( sample_name, action_name )
+
+  fig = plt.figure()
+  ax = fig.add_subplot(111, projection='3d')
+  ob = viz.Ax3DPose(ax)
+  try:
+    anim = viz.animate( fig, ob, xyz_gt, xyz_pred, fps=fps )
+    anim.save( save_name, writer=animation.PillowWriter(fps=fps) )
+  finally:
+    plt.close( fig )
+  return save_name
+
+
+def _render( job ):
+  return render_sequence( *job )
+
+
+def render_all( sample_name, out_dir, actions=None, seeds=None, suffix='', fps=25, num_workers=None ):
+  """
+  Render the sequences of a file of samples to out_dir/<action>_<seed><suffix>.gif,
+  one process per sequence.
+
+  Args
+    sample_name: h5 file written by translate.py --sample
+    out_dir: directory of the gif files, created if needed
+    actions: actions to render, or None for all of them
+    seeds: indices of the seeds to render, or None for all of them
+    suffix: appended to the name of each file
+    fps: frames per second
+    num_workers: number of processes to use. None uses one per core, and 0 or 1
+      renders in this process
+  Returns
+    save_names: list of the files written
+  """
+  jobs = []
+  for name in list_sequences( sample_name ):
+    action, seed = name.rsplit( '_', 1 )
+    if actions is not None and action not in actions:
+      continue
+    if seeds is not None and int(seed) not in seeds:
+      continue
+    jobs.append( (sample_name, name, os.path.join(out_dir, name + suffix + '.gif'), fps) )
+
+  if not os.path.isdir( out_dir ):
+    os.makedirs( out_dir )
+
+  if num_workers is None:
+    num_workers = os.cpu_count() or 1
+  num_workers = min( num_workers, len(jobs) )
+
+  if num_workers <= 1:
+    return [_render( job ) for job in jobs]
+
+  with ProcessPoolExecutor( max_workers=num_workers ) as executor:
+    return list( executor.map(_render, jobs) )
+
+
+def parse_args( argv=None ):
+  parser = argparse.ArgumentParser(description='Render the samples of a model to gif files')
+  parser.add_argument('--sample_name', type=str, default='samples.h5', help='h5 file written by translate.py --sample')
+  parser.add_argument('--out_dir', type=str, default='figs', help='directory of the gif files')
+  parser.add_argument('--actions', type=str, default='', help='comma separated actions to render, all if empty')
+  parser.add_argument('--seeds', type=str, default='', help='comma separated seeds to render, all if empty')
+  parser.add_argument('--suffix', type=str, default='', help='appended to the name of each file, e.g. _py')
+  parser.add_argument('--fps', type=int, default=25, help='frames per second')
+  parser.add_argument('--num_workers', type=int, default=None, help='number of processes, one per core by default')
+  return parser.parse_args(argv)
+
+
+def main():
+  args = parse_args()
+  actions = [a for a in args.actions.split(',') if a] or None
+  seeds = [int(s) for s in args.seeds.split(',') if s] or None
+
+  save_names = render_all( args.sample_name, args.out_dir, actions=actions, seeds=seeds, suffix=args.suffix,
+                           fps=args.fps, num_workers=args.num_workers )
+  print("Rendered {0} sequences to {1}".format( len(save_names), args.out_dir ))
+
+
+if __name__ == '__main__':
+  main()
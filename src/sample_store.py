@@ -0,0 +1,199 @@
+"""Chunked and compressed h5 store of the samples of a model on srnn's seeds.
+
+All the sequences of the same kind (ground truths, predictions, their 3d
+points, the stochastic samples) are stacked in a single dataset, with one row
+per (action, seed) in the order of the index table. The datasets are chunked
+by row and compressed, so that any (action, seed) can be read without reading
+the rest. The errors are stored with one row per action.
+
+  index             (n_actions * seeds_per_action,) table of (action, seed)
+  expmap/gt         (rows, seq_length_out, 99)
+  expmap/preds      (rows, seq_length_out, 99)
+  expmap/samples    (rows, num_samples, seq_length_out, 99)
+  xyz/gt, xyz/preds (rows, seq_length_out, 96)
+  errors/<name>     (n_actions, seq_length_out), NaN for the actions not written
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+
+import h5py
+import numpy as np
+
+STORE_FORMAT = 'srnn_samples'
+STORE_VERSION = 1
+CHUNK_BYTES = 2**20  # upper bound on the size of a chunk
+
+def is_store( path ):
+  """Whether an h5 file was written by SampleWriter"""
+  with h5py.File( path, 'r' ) as h5f:
+    return h5f.attrs.get( 'format' ) == STORE_FORMAT
+
+
+def _chunks( shape, itemsize ):
+  """One row per chunk, with the second axis split if a row is larger than CHUNK_BYTES"""
+  row = int( np.prod(shape[1:]) ) * itemsize
+  if len(shape) < 3 or row <= CHUNK_BYTES:
+    return (1,) + tuple(shape[1:])
+  per_chunk = max( 1, CHUNK_BYTES // (row // shape[1]) )
+  return (1, min(per_chunk, shape[1])) + tuple(shape[2:])
+
+
+class SampleWriter(object):
+  def __init__(self, path, actions, seeds_per_action=8, compression='gzip', compression_opts=4):
+    """
+    Write the samples of a run to a new file, through a single handle kept
+    open until close. Use as a context manager.
+
+    Args
+      path: file to write, replaced if it exists
+      actions: list of the actions, the rows of the seeds of actions[i] are
+        seeds_per_action*i to seeds_per_action*(i+1)-1
+      seeds_per_action: number of seeds of each action
+      compression, compression_opts: h5py compression filter of the datasets
+    """
+    self.actions = list( actions )
+    self.seeds_per_action = seeds_per_action
+    self.compression = compression
+    self.compression_opts = compression_opts
+
+    self.h5f = h5py.File( path, 'w' )
+    self.h5f.attrs['format'] = STORE_FORMAT
+    self.h5f.attrs['version'] = STORE_VERSION
+    self.h5f.attrs['actions'] = json.dumps( self.actions )
+    self.h5f.attrs['seeds_per_action'] = seeds_per_action
+
+    index = np.zeros( len(self.actions) * seeds_per_action, dtype=[('action', 'S32'), ('seed', '<i4')] )
+    index['action'] = np.repeat( [a.encode('utf-8') for a in self.actions], seeds_per_action )
+    index['seed'] = np.tile( np.arange(seeds_per_action), len(self.actions) )
+    self.h5f.create_dataset( 'index', data=index )
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    if self.h5f is not None:
+      self.h5f.close()
+      self.h5f = None
+
+  def rows(self, action):
+    """Slice of the rows of the seeds of an action"""
+    start = self.actions.index( action ) * self.seeds_per_action
+    return slice( start, start + self.seeds_per_action )
+
+  def _dataset(self, name, num_rows, row_shape, dtype, fillvalue=None):
+    if name not in self.h5f:
+      shape = (num_rows,) + tuple(row_shape)
+      self.h5f.create_dataset( name, shape=shape, dtype=dtype, chunks=_chunks(shape, np.dtype(dtype).itemsize),
+                               compression=self.compression, compression_opts=self.compression_opts, shuffle=True,
+                               fillvalue=fillvalue )
+    return self.h5f[name]
+
+  def write(self, name, data, action=None):
+    """
+    Write sequences of every seed, or of the seeds of one action.
+
+    Args
+      name: dataset to write, e.g. expmap/preds
+      data: (rows, ...) array with a row per seed, in the order of the index
+      action: action whose seeds are in data, or None if data has all the rows
+    """
+    data = np.asarray( data )
+    dset = self._dataset( name, len(self.actions) * self.seeds_per_action, data.shape[1:], data.dtype )
+    dset[ slice(None) if action is None else self.rows(action) ] = data
+
+  def write_draws(self, name, action, start, data, num_draws):
+    """
+    Write some of the draws of every seed of an action, so that many draws can
+    be written a few at a time.
+
+    Args
+      name: dataset to write, e.g. expmap/samples, of (rows, num_draws, ...) sequences
+      action: action whose seeds are in data
+      start: index of the first draw in data
+      data: (seeds_per_action, k, ...) array with the draws start to start+k-1
+      num_draws: total number of draws of each seed
+    """
+    data = np.asarray( data )
+    dset = self._dataset( name, len(self.actions) * self.seeds_per_action, (num_draws,) + data.shape[2:], data.dtype )
+    dset[ self.rows(action), start:start + data.shape[1] ] = data
+
+  def write_errors(self, name, action, errors):
+    """Write the (seq_length_out,) errors of an action to errors/<name>"""
+    errors = np.asarray( errors, dtype=np.float64 )
+    dset = self._dataset( 'errors/' + name, len(self.actions), errors.shape, errors.dtype, fillvalue=np.nan )
+    dset[ self.actions.index(action) ] = errors
+
+
+class SampleReader(object):
+  def __init__(self, path):
+    """
+    Random access to the samples written by SampleWriter. The row of each
+    (action, seed) is read from the index table. Use as a context manager.
+
+    Args
+      path: file written by SampleWriter
+    """
+    self.h5f = h5py.File( path, 'r' )
+    if self.h5f.attrs.get( 'format' ) != STORE_FORMAT:
+      self.h5f.close()
+      raise IOError("{0} is not a sample store".format( path ))
+    self.actions = json.loads( self.h5f.attrs['actions'] )
+    self.seeds_per_action = int( self.h5f.attrs['seeds_per_action'] )
+
+    # (action, seed) of each row, and the row of each seed of each action
+    self.index = [(action.decode('utf-8'), int(seed)) for action, seed in self.h5f['index'][:]]
+    self._rows = {}
+    for row, (action, seed) in enumerate( self.index ):
+      self._rows.setdefault( action, {} )[seed] = row
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  def close(self):
+    self.h5f.close()
+
+  def __contains__(self, name):
+    return name in self.h5f
+
+  def row(self, action, seed):
+    if seed not in self._rows.get( action, {} ):
+      raise KeyError("No seed {0} of {1} in the index".format( seed, action ))
+    return self._rows[action][seed]
+
+  def rows(self, action):
+    """Rows of the seeds of an action, in the order of the seeds"""
+    if action not in self._rows:
+      raise KeyError("No action {0} in the index".format( action ))
+    return [self._rows[action][seed] for seed in sorted( self._rows[action] )]
+
+  def get(self, name, action, seed=None):
+    """
+    Read the sequences of one seed of an action, or of all its seeds.
+
+    Args
+      name: dataset to read, e.g. expmap/preds
+      action: the action
+      seed: index of the seed within the action, or None for all of them
+    Returns
+      data: the row of the seed, or the (seeds, ...) rows of the action
+    """
+    if seed is None:
+      rows = self.rows( action )
+      if rows == list( range(rows[0], rows[-1] + 1) ):
+        return self.h5f[name][ rows[0]:rows[-1] + 1 ]
+      return np.stack( [self.h5f[name][row] for row in rows] )
+    return self.h5f[name][ self.row(action, seed) ]
+
+  def errors(self, name, action):
+    """Read the errors of an action stored by SampleWriter.write_errors"""
+    return self.h5f[ 'errors/' + name ][ self.actions.index(action) ]
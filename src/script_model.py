@@ -0,0 +1,119 @@
+"""Export of a trained Seq2SeqModel to a TorchScript inference graph.
+
+The exported graph contains the encoder and the whole autoregressive decoding
+loop, so predicting a sequence is a single call into the TorchScript
+interpreter. This module only depends on torch: a saved graph can be loaded
+and run with load_scripted (or torch.jit.load) without the training code.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import time
+
+import torch
+import torch.nn as nn
+from typing import Final, Optional
+
+class InferenceGraph(nn.Module):
+    stochastic: Final[bool]
+    residual: Final[bool]
+    output_size: Final[int]
+    target_seq_len: Final[int]
+
+    def __init__(self, model):
+        """
+        Scriptable copy of the inference path of a Seq2SeqModel. The modules
+        are shared with the model, not copied.
+
+        Args
+          model: a Seq2SeqModel, with a DecoderWrapper or StochasticDecoderWrapper decoder
+        """
+        super(InferenceGraph, self).__init__()
+        self.encoder = model.encoder
+        self.cell = model.decoder._cell
+        self.stochastic = model.stochastic
+        self.residual = model.decoder.residual
+        self.output_size = model.decoder.output_size
+        self.target_seq_len = model.decoder.target_seq_len
+        if self.stochastic:
+            self.head = model.decoder.mean
+            self.std = model.decoder.std
+        else:
+            self.head = model.decoder.linear
+            self.std = nn.Identity()
+
+    def forward(self, encoder_input, decoder_input, noise: Optional[torch.Tensor] = None):
+        """
+        Args
+          encoder_input: (source_seq_len-1) * batch * input_size tensor
+          decoder_input: seq * batch * input_size tensor, only its first frame is used
+          noise: optional target_seq_len * batch * output_size standard normal
+            noise of a stochastic decoder. Drawn in the graph if None.
+        Returns
+          output: target_seq_len * batch * input_size tensor with the predicted
+            frames (the samples for a stochastic decoder)
+        """
+        _, state = self.encoder(encoder_input)
+        input = decoder_input[0:1]
+        trailing = input[:, :, self.output_size:]
+
+        frames = []
+        for i in range(self.target_seq_len):
+            temp, state = self.cell(input, state)
+            prediction = self.head(temp)
+            if self.stochastic:
+                std = self.std(temp)
+                if noise is None:
+                    prediction = torch.randn_like(std) * std + prediction
+                else:
+                    prediction = noise[i:i+1] * std + prediction
+            if self.residual:
+                prediction = prediction + input[:, :, :self.output_size]
+            frame = torch.cat([prediction, trailing], 2)
+            frames.append(frame)
+            # Same as the decoder wrappers: only the stochastic decoder feeds
+            # its prediction back as the next input
+            if self.stochastic:
+                input = frame
+        return torch.cat(frames, 0)
+
+
+def export_torchscript(model, path):
+    """
+    Script the inference path of a model and save it.
+
+    Args
+      model: the Seq2SeqModel to export, in eval mode
+      path: where to save the TorchScript module
+    Returns
+      scripted: the scripted module
+    """
+    scripted = torch.jit.script(InferenceGraph(model).eval())
+    torch.jit.save(scripted, path)
+    return scripted
+
+
+def load_scripted(path, device=None):
+    """Load a module saved by export_torchscript, ready for inference"""
+    scripted = torch.jit.load(path, map_location=device)
+    scripted.eval()
+    return scripted
+
+
+def measure_latency(forward, encoder_input, decoder_input, repeats=20, warmup=3):
+    """
+    Average wall time of forward(encoder_input, decoder_input), in ms.
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            forward(encoder_input, decoder_input)
+        if encoder_input.is_cuda:
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for _ in range(repeats):
+            forward(encoder_input, decoder_input)
+        if encoder_input.is_cuda:
+            torch.cuda.synchronize()
+    return (time.time() - start_time) * 1000 / repeats
@@ -45,7 +45,8 @@ class Seq2SeqModel(nn.Module):
         batch_size: the size of the batches used during training;
         the model construction is independent of batch_size, so it can be
         changed after initialization if this is convenient, e.g., for decoding.
-        summaries_dir: where to log progress for tensorboard.
+        summaries_dir: where to log progress for tensorboard, None to not log,
+        e.g. for a teacher that is only evaluated.
         loss_to_use: [supervised, sampling_based]. Whether to use ground truth in
         each timestep to compute the loss after decoding, or to feed back the
         prediction from the previous time-step.
@@ -62,8 +63,11 @@ class Seq2SeqModel(nn.Module):
         print("One hot is ", one_hot)
         print("Input size is %d" % self.input_size)
 
-        self.train_writer = SummaryWriter(os.path.normpath(os.path.join(summaries_dir, 'train')))
-        self.test_writer = SummaryWriter(os.path.normpath(os.path.join(summaries_dir, 'test')))
+        if summaries_dir is None:
+            self.train_writer, self.test_writer = None, None
+        else:
+            self.train_writer = SummaryWriter(os.path.normpath(os.path.join(summaries_dir, 'train')))
+            self.test_writer = SummaryWriter(os.path.normpath(os.path.join(summaries_dir, 'test')))
 
         self.source_seq_len = source_seq_len
         self.target_seq_len = target_seq_len
@@ -71,6 +75,9 @@ class Seq2SeqModel(nn.Module):
         self.batch_size = batch_size
         self.num_layers = num_layers
         self.stochastic = stochastic
+        if loss_to_use not in ["supervised", "sampling_based"]:
+            raise ValueError("Unknown loss: %s" % loss_to_use)
+        self.loss_to_use = loss_to_use
         # === Create the RNN that will keep the state ===
         print('rnn_size= {0}'.format(rnn_size))
         self.encoder = nn.GRU(input_size=self.input_size,hidden_size=self.rnn_size,num_layers=num_layers)
@@ -96,17 +103,54 @@ class Seq2SeqModel(nn.Module):
                 dtype)
             self.loss = nll_gauss
 
-    def forward(self, encoder_input, decoder_input):
+    def forward(self, encoder_input, decoder_input, generator=None):
         # h0 = torch.zeros(self.num_layers, self.batch_size, self.rnn_size).cuda()
         features , inter_state = self.encoder(encoder_input,None)
+
+        # With the supervised loss the decoder is fed the ground truth, so all
+        # the steps run in a single pass while training
+        if self.training and self.loss_to_use == "supervised":
+            if not self.stochastic:
+                return self.decoder.teacher_forced(decoder_input, inter_state)
+            else:
+                return self.decoder.teacher_forced(decoder_input, inter_state, generator)
+
         last_frame = decoder_input[0,:,:].view(1,-1,self.input_size)
         if not self.stochastic:
             output, state = self.decoder(last_frame, inter_state)
             return output, state
         else:
-            means, stds, samples, state = self.decoder(last_frame, inter_state)
+            means, stds, samples, state = self.decoder(last_frame, inter_state, generator)
             return means, stds, samples, state
 
+    def sample_many(self, encoder_input, decoder_input, num_samples, chunk_size=None, generator=None):
+        """
+        Draw several trajectories for each sequence with the stochastic decoder.
+        The input is encoded once, and its state repeated so that the
+        trajectories of chunk_size samples are decoded in a single batched pass.
+
+        Args
+          encoder_input: (source_seq_len-1) * batch * input_size tensor
+          decoder_input: seq * batch * input_size tensor, only its first frame is used
+          num_samples: number of trajectories to draw for each sequence
+          chunk_size: maximum number of samples decoded together. All of them if None.
+          generator: optional torch.Generator to draw the noise from
+        Yields
+          samples: target_seq_len * (k * batch) * input_size tensor with the next
+            k <= chunk_size samples of every sequence. Sample j of sequence b is
+            in column j * batch + b.
+        """
+        if not self.stochastic:
+            raise ValueError("Only a stochastic decoder can draw several samples")
+        chunk_size = num_samples if chunk_size is None else max(chunk_size, 1)
+
+        _, inter_state = self.encoder(encoder_input, None)
+        last_frame = decoder_input[0:1]
+        for start in xrange(0, num_samples, chunk_size):
+            k = min(chunk_size, num_samples - start)
+            _, _, samples, _ = self.decoder(last_frame.repeat(1, k, 1), inter_state.repeat(1, k, 1), generator)
+            yield samples
+
     def get_batch( self, data, actions ):
         """Get a random batch of data from the specified bucket, prepare for step.
 
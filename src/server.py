@@ -0,0 +1,303 @@
+"""Local inference server that batches the requests of many concurrent streams.
+
+Clients talk newline-delimited JSON over a Unix socket or a localhost TCP
+port. Every line is a request object with an "op" and an optional "id" that
+is echoed back in the response:
+
+  {"op": "open", "stream": "s0", "action": "walking"}
+  {"op": "push", "stream": "s0", "frame": [99 floats]}
+  {"op": "forecast", "stream": "s0"}  ->  {"poses": target_seq_len x 99 floats}
+  {"op": "close", "stream": "s0"}
+  {"op": "stats"}                     ->  latency, batch sizes and throughput
+
+Requests from all the connections go through a single queue. They are
+gathered into micro-batches of at most max_batch requests, waiting at most
+max_wait seconds after the first one, and each batch runs on an
+OnlinePredictor with one encoder step for all the pushed frames and one
+decoder pass for all the forecasts.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import asyncio
+import collections
+import json
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+class _Request(object):
+    def __init__(self, op, msg, future):
+        self.op = op
+        self.msg = msg
+        self.future = future
+        self.start_time = time.time()
+
+class ServerMetrics(object):
+    def __init__(self, window=10000):
+        """
+        Latency, batch size and throughput counters of the server.
+
+        Args
+          window: number of recent requests of each op kept for the latency percentiles
+        """
+        self.start_time = time.time()
+        self.latencies = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.requests = collections.Counter()
+        self.errors = 0
+        self.batches = 0
+        self.batch_sizes = collections.Counter()     # requests per micro-batch
+        self.forecast_sizes = collections.Counter()  # streams per decoder pass
+
+    def record(self, op, latency, error=False):
+        self.requests[op] += 1
+        self.latencies[op].append(latency)
+        if error:
+            self.errors += 1
+
+    def summary(self):
+        """
+        Returns
+          summary: JSON-serializable dict with the p50/p99 latency of each op in
+            ms, the histograms of batch sizes and the throughput since start
+        """
+        elapsed = max(time.time() - self.start_time, 1e-9)
+        latency = {}
+        for op, values in self.latencies.items():
+            p50, p99 = np.percentile(np.array(values) * 1000, [50, 99])
+            latency[op] = {'p50_ms': float(p50), 'p99_ms': float(p99), 'count': len(values)}
+        return {'uptime_s': elapsed,
+                'requests': dict(self.requests),
+                'errors': self.errors,
+                'batches': self.batches,
+                'latency': latency,
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'forecast_batch_histogram': {str(k): v for k, v in sorted(self.forecast_sizes.items())},
+                'throughput': {'requests_per_s': sum(self.requests.values()) / elapsed,
+                               'forecasts_per_s': self.requests['forecast'] / elapsed,
+                               'frames_per_s': self.requests['push'] / elapsed}}
+
+class InferenceServer(object):
+    def __init__(self, predictor, max_batch=64, max_wait=0.005):
+        """
+        Args
+          predictor: the OnlinePredictor that keeps the streams. It is only used
+            from a single worker thread.
+          max_batch: maximum number of requests in a micro-batch
+          max_wait: maximum time, in seconds, to wait for more requests after
+            the first one of a batch
+        """
+        self.predictor = predictor
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = ServerMetrics()
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue = None
+
+    async def submit(self, msg):
+        """Queue a request and wait for its result"""
+        op = msg.get('op')
+        if op == 'stats':
+            return self.metrics.summary()
+        if op not in ('open', 'push', 'forecast', 'close'):
+            raise ValueError("Unknown op: {0}".format(op))
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put(_Request(op, msg, future))
+        return await future
+
+    async def _next_batch(self):
+        """Wait for a request, then gather more until the batch is full or max_wait passed"""
+        batch = [await self.queue.get()]
+        deadline = asyncio.get_running_loop().time() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - asyncio.get_running_loop().time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            results = await loop.run_in_executor(self.executor, self._run_batch, batch)
+
+            self.metrics.batches += 1
+            self.metrics.batch_sizes[len(batch)] += 1
+            now = time.time()
+            for request, (value, error) in zip(batch, results):
+                self.metrics.record(request.op, now - request.start_time, error is not None)
+                if request.future.done():
+                    continue
+                if error is not None:
+                    request.future.set_exception(error)
+                else:
+                    request.future.set_result(value)
+
+    def _run_batch(self, batch):
+        """
+        Run a micro-batch on the predictor, in the worker thread.
+
+        The requests are split into rounds that keep their order: in a round,
+        every stream gets at most one frame, all the frames are pushed in one
+        step, then all the forecasts run in one decoder pass. A round ends
+        before a second frame for the same stream, a frame for a stream that
+        already has a forecast in the round, or an open/close.
+
+        Returns
+          results: list with a (value, error) tuple for each request
+        """
+        results = [(None, None)] * len(batch)
+        pushes, forecasts = collections.OrderedDict(), []
+
+        def flush():
+            if pushes:
+                indices = [i for i, _ in pushes.values()]
+                try:
+                    self.predictor.push_many(list(pushes.keys()), np.stack([frame for _, frame in pushes.values()]))
+                    for i in indices:
+                        results[i] = ({}, None)
+                except Exception as e:
+                    for i in indices:
+                        results[i] = (None, e)
+            if forecasts:
+                self.metrics.forecast_sizes[len(forecasts)] += 1
+                try:
+                    poses = self.predictor.forecast_many([batch[i].msg['stream'] for i in forecasts])
+                    for i, pose in zip(forecasts, poses):
+                        results[i] = ({'poses': pose.tolist()}, None)
+                except Exception as e:
+                    for i in forecasts:
+                        results[i] = (None, e)
+            pushes.clear()
+            del forecasts[:]
+
+        for i, request in enumerate(batch):
+            stream = request.msg.get('stream')
+            try:
+                if request.op == 'push':
+                    if stream in pushes or any(batch[j].msg['stream'] == stream for j in forecasts):
+                        flush()
+                    if stream not in self.predictor.streams:
+                        raise KeyError("Unknown stream {0}".format(stream))
+                    # Converted here, so that a bad frame only fails its own request
+                    frame = np.asarray(request.msg.get('frame', []), dtype=np.float32)
+                    if frame.shape != (99,):
+                        raise ValueError("A frame must have 99 values")
+                    pushes[stream] = (i, frame)
+                elif request.op == 'forecast':
+                    if stream not in self.predictor.streams:
+                        raise KeyError("Unknown stream {0}".format(stream))
+                    if self.predictor.num_frames(stream) == 0 and stream not in pushes:
+                        raise ValueError("Stream {0} has not received any frame".format(stream))
+                    forecasts.append(i)
+                else:
+                    flush()
+                    if request.op == 'open':
+                        self.predictor.open_stream(stream, request.msg.get('action'))
+                    else:
+                        self.predictor.close_stream(stream)
+                    results[i] = ({}, None)
+            except Exception as e:
+                results[i] = (None, e)
+        flush()
+        return results
+
+    async def _handle_connection(self, reader, writer):
+        pending = set()
+
+        async def respond(msg):
+            response = {'id': msg.get('id')} if isinstance(msg, dict) else {}
+            try:
+                if not isinstance(msg, dict):
+                    raise ValueError("A request must be a JSON object")
+                response.update(await self.submit(msg))
+            except Exception as e:
+                response['error'] = '{0}: {1}'.format(type(e).__name__, e)
+            writer.write((json.dumps(response) + '\n').encode('utf-8'))
+
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                if not line.strip():
+                    continue
+                try:
+                    msg = json.loads(line)
+                except ValueError:
+                    msg = None
+                # Requests of a connection are answered as they complete, so a
+                # client can pipeline many of them
+                task = asyncio.ensure_future(respond(msg))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+                await writer.drain()
+            if pending:
+                await asyncio.gather(*pending)
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, path=None, host='127.0.0.1', port=0, stats_every=0):
+        """
+        Serve until cancelled, on a Unix socket if a path is given, or else on a
+        TCP port of host.
+
+        Args
+          path: path of the Unix socket
+          host: address to listen on for TCP
+          port: TCP port, 0 to pick a free one
+          stats_every: print the metrics every this many seconds, 0 to never print them
+        """
+        self.queue = asyncio.Queue()
+        if path is not None:
+            server = await asyncio.start_unix_server(self._handle_connection, path=path)
+        else:
+            server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+        self.address = server.sockets[0].getsockname()
+        print("Serving on {0}".format(self.address))
+
+        batcher = asyncio.ensure_future(self._batch_loop())
+        try:
+            async with server:
+                if stats_every > 0:
+                    while True:
+                        await asyncio.sleep(stats_every)
+                        print(json.dumps(self.metrics.summary()))
+                else:
+                    await server.serve_forever()
+        finally:
+            batcher.cancel()
+            self.executor.shutdown(wait=False)
+
+class Client(object):
+    def __init__(self, path=None, host='127.0.0.1', port=None):
+        """Minimal blocking client of an InferenceServer, for a Unix socket path or a TCP port"""
+        if path is not None:
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.sock.connect(path)
+        else:
+            self.sock = socket.create_connection((host, port))
+        self.file = self.sock.makefile('rwb')
+
+    def request(self, op, **kwargs):
+        """Send a request and wait for its response. Raises RuntimeError if the server returns an error"""
+        msg = dict(kwargs, op=op)
+        self.file.write((json.dumps(msg) + '\n').encode('utf-8'))
+        self.file.flush()
+        response = json.loads(self.file.readline())
+        if 'error' in response:
+            raise RuntimeError(response['error'])
+        return response
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
@@ -0,0 +1,220 @@
+"""Torch ports of the data_utils functions used for evaluation, so that they can
+run on the same device as the model"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+import forward_kinematics
+
+def revert_output_format(normalizedData, data_mean, data_std, dimensions_to_use, one_hot, number_of_actions):
+  """
+  Torch version of data_utils.revert_output_format. Takes the time-major output
+  of the model and un-normalizes the whole batch at once.
+
+  Args
+    normalizedData: (seq_length, batch_size, dim) tensor with normalized data
+    data_mean: d-long tensor with the mean used to normalize the data
+    data_std: d-long tensor with the standard deviation used to normalize the data
+    dimensions_to_use: tensor with the dimensions used by the model
+    one_hot: whether the data comes with one-hot encoding
+    number_of_actions: length of the one-hot encoding
+  Returns
+    origData: (batch_size, seq_length, d) tensor with the un-normalized data
+  """
+  poses = normalizedData.transpose(0, 1)
+  if one_hot:
+    poses = poses[:, :, :-number_of_actions]
+
+  T, B = poses.shape[1], poses.shape[0]
+  origData = torch.zeros(B, T, data_mean.shape[0], dtype=data_mean.dtype, device=data_mean.device)
+  origData[:, :, dimensions_to_use] = poses.to(data_mean.dtype)
+  return origData * data_std + data_mean
+
+
+def expmap2rotmat(r):
+  """
+  Torch version of data_utils.expmap2rotmat_batch (Rodrigues' formula).
+
+  Args
+    r: (..., 3) tensor of exponential maps
+  Returns
+    R: (..., 3, 3) tensor of rotation matrices
+  """
+  theta = torch.norm(r, dim=-1, keepdim=True)
+  r0 = r / (theta + np.finfo(np.float32).eps)
+
+  zeros = torch.zeros_like(r0[..., 0])
+  r0x = torch.stack([zeros, -r0[..., 2], r0[..., 1],
+                     r0[..., 2], zeros, -r0[..., 0],
+                     -r0[..., 1], r0[..., 0], zeros], dim=-1).view(r.shape[:-1] + (3, 3))
+
+  theta = theta.unsqueeze(-1)
+  eye = torch.eye(3, dtype=r.dtype, device=r.device)
+  return eye + torch.sin(theta) * r0x + (1 - torch.cos(theta)) * torch.matmul(r0x, r0x)
+
+
+def rotmat2euler(R):
+  """
+  Torch version of data_utils.rotmat2euler_batch, gimbal lock included.
+
+  Args
+    R: (..., 3, 3) tensor of rotation matrices
+  Returns
+    eul: (..., 3) tensor with the Euler angle representation of each R
+  """
+  R02 = R[..., 0, 2]
+  lock_neg = R02 == -1
+  lock = (R02 == 1) | lock_neg
+
+  # special case, E3 is set arbitrarily to 0
+  dlta = torch.atan2(R[..., 0, 1], R02)
+  E2_lk = torch.where(lock_neg, torch.full_like(R02, np.pi / 2), torch.full_like(R02, -np.pi / 2))
+
+  # general case, with the special case masked out to avoid dividing by zero
+  E2 = -torch.asin(torch.where(lock, torch.zeros_like(R02), R02))
+  cosE2 = torch.cos(E2)
+  E1 = torch.atan2(R[..., 1, 2] / cosE2, R[..., 2, 2] / cosE2)
+  E3 = torch.atan2(R[..., 0, 1] / cosE2, R[..., 0, 0] / cosE2)
+
+  return torch.stack([torch.where(lock, dlta, E1),
+                      torch.where(lock, E2_lk, E2),
+                      torch.where(lock, torch.zeros_like(E3), E3)], dim=-1)
+
+
+def expmap2euler_channels(channels):
+  """
+  Torch version of data_utils.expmap2euler_channels.
+
+  Args
+    channels: (..., 99) tensor of poses in exponential map format
+  Returns
+    eulerchannels: (..., 99) tensor of poses with the rotations in Euler angles
+  """
+  expmaps = channels[..., 3:99].reshape(channels.shape[:-1] + (32, 3))
+  euler = rotmat2euler(expmap2rotmat(expmaps)).reshape(channels.shape[:-1] + (96,))
+  return torch.cat([channels[..., :3], euler], dim=-1)
+
+
+def euler_error(eulerchannels_pred, eulerchannels_gt, mask_on_pred=False):
+  """
+  Per-frame Euler angle error between predicted and ground-truth sequences.
+  Torch port of the error function provided by Ashesh Jain (in matlab), available at
+  https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/dataParser/Utils/motionGenerationError.m#L40-L54
+
+  The global translation and rotation (first 6 entries) are not considered,
+  and only the dimensions with sufficient standard deviation over time are
+  used: those of the ground truth, or those of each prediction if mask_on_pred,
+  as in the errors saved by translate.py --sample.
+
+  Args
+    eulerchannels_pred: (batch_size, seq_length, 99) tensor of predicted poses
+    eulerchannels_gt: (batch_size, seq_length, 99) tensor of ground truth poses
+    mask_on_pred: pick the dimensions on the prediction instead of the ground truth
+  Returns
+    euc_error: (batch_size, seq_length) tensor with the error of each frame
+  """
+  gt = eulerchannels_gt.clone()
+  gt[:, :, 0:6] = 0
+  pred = eulerchannels_pred.to(gt.dtype)
+  if mask_on_pred:
+    pred = pred.clone()
+    pred[:, :, 0:6] = 0
+
+  idx_to_use = (torch.std(pred if mask_on_pred else gt, dim=1, unbiased=False) > 1e-4).to(gt.dtype)
+
+  euc_error = torch.pow(gt - pred, 2) * idx_to_use.unsqueeze(1)
+  return torch.sqrt(torch.sum(euc_error, dim=2))
+
+
+class ForwardKinematics(object):
+  def __init__(self, parent, offset, rotInd, expmapInd, device=None, dtype=torch.float64):
+    """
+    Torch version of forward_kinematics.fkl_batch. The kinematic tree is kept
+    on the device, and the joints are transformed level by level without
+    in-place updates, so that the 3d points are differentiable.
+
+    Args
+      parent, offset, rotInd, expmapInd: the kinematic tree, see forward_kinematics._some_variables
+      device: device to keep the tree on
+      dtype: precision of the computation
+    """
+    levels = forward_kinematics.kinematic_levels(parent)
+    order = np.concatenate(levels)
+
+    # The parents of a level are all in the previous one, so each level only
+    # indexes into the tensors of the previous level
+    self.levels = []
+    for depth, level in enumerate(levels):
+      parents = None if depth == 0 else np.searchsorted(levels[depth-1], parent[level])
+      self.levels.append((torch.tensor(level, dtype=torch.long, device=device),
+                          None if parents is None else torch.tensor(parents, dtype=torch.long, device=device)))
+    self.inverse_order = torch.tensor(np.argsort(order), dtype=torch.long, device=device)
+
+    self.offset = torch.tensor(offset, dtype=dtype, device=device)
+    self.posInd = torch.tensor(forward_kinematics.position_indices(rotInd), dtype=torch.long, device=device)
+    self.expmapInd = torch.tensor(np.array(expmapInd), dtype=torch.long, device=device)
+
+  def __call__(self, angles):
+    """
+    Args
+      angles: (..., 99) tensor with 3d positions and 3d joint angles in expmap format
+    Returns
+      xyz: (..., 96) tensor with the 32 3d points of each pose
+    """
+    batch_shape = angles.shape[:-1]
+
+    # The poses go in the last, contiguous dimension, so that the products of
+    # 3x3 matrices are written as broadcasted sums over whole rows of poses,
+    # which is much faster than batched matmuls of tiny matrices
+    angles = angles.to(self.offset.dtype).reshape(-1, 99).t()
+    padded = torch.cat([angles, torch.zeros_like(angles[:1])], dim=0)
+    positions = self.offset.unsqueeze(-1) + padded[self.posInd]
+    local_rotations = self._expmap2rotmat(angles[self.expmapInd])
+
+    xyz = []
+    for level, parents in self.levels:
+      level_positions = positions[level]
+      level_rotations = local_rotations[level]
+      if parents is not None:
+        parent_rotations = rotations[parents]
+        level_positions = torch.sum(level_positions.unsqueeze(2) * parent_rotations, dim=1) + xyz[-1][parents]
+        level_rotations = torch.sum(level_rotations.unsqueeze(3) * parent_rotations.unsqueeze(1), dim=2)
+      xyz.append(level_positions)
+      rotations = level_rotations
+
+    xyz = torch.cat(xyz, dim=0)[self.inverse_order]
+    xyz = xyz[:, [0, 2, 1]]
+    return xyz.reshape(96, -1).t().reshape(batch_shape + (96,))
+
+  @staticmethod
+  def _expmap2rotmat(r):
+    """expmap2rotmat for a joints * 3 * poses tensor, returns joints * 3 * 3 * poses rotation matrices"""
+    theta = torch.linalg.vector_norm(r, dim=1, keepdim=True)
+    r0 = r / (theta + np.finfo(np.float32).eps)
+
+    zeros = torch.zeros_like(r0[:, 0])
+    r0x = torch.stack([zeros, -r0[:, 2], r0[:, 1],
+                       r0[:, 2], zeros, -r0[:, 0],
+                       -r0[:, 1], r0[:, 0], zeros], dim=1).view(r.shape[0], 3, 3, -1)
+
+    theta = theta.unsqueeze(1)
+    eye = torch.eye(3, dtype=r.dtype, device=r.device).view(1, 3, 3, 1)
+    return eye + torch.sin(theta) * r0x + (1 - torch.cos(theta)) * torch.sum(r0x.unsqueeze(3) * r0x.unsqueeze(1), dim=2)
+
+
+def mpjpe(xyz_pred, xyz_gt):
+  """
+  Mean per joint position error of each pose.
+
+  Args
+    xyz_pred: (..., 96) tensor with the predicted 3d points of 32 joints
+    xyz_gt: (..., 96) tensor with the ground truth 3d points
+  Returns
+    error: (...) tensor with the mean euclidean distance over the joints
+  """
+  diff = (xyz_pred.to(xyz_gt.dtype) - xyz_gt).view(xyz_gt.shape[:-1] + (-1, 3))
+  return torch.mean(torch.norm(diff, dim=-1), dim=-1)
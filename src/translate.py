@@ -4,6 +4,8 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import io
+import itertools
 import math
 import os
 import random
@@ -11,12 +13,25 @@ import sys
 import time
 import h5py
 import argparse
+import asyncio
+import json
 
 import numpy as np
 from six.moves import xrange # pylint: disable=redefined-builtin
 from helper import *
 
 import data_utils
+import data_cache
+import forward_kinematics
+import sample_store
+import torch_utils
+import evaluation
+import batch_sampler
+import script_model
+import onnx_model
+import quantize as quantization
+import online
+import server
 import seq2seq_model
 import discriminator
 import torch
@@ -38,6 +53,14 @@ parser.add_argument("--seq_length_out", default=25, type=int, metavar='N', help=
 parser.add_argument("--omit_one_hot", action='store_true', help="Whether to remove one-hot encoding from the data")
 parser.add_argument("--residual_velocities", action='store_true', help="Add a residual connection that effectively models velocities")
 parser.add_argument("--data_dir", default=os.path.normpath("./data/h3.6m/dataset"), type=str, metavar='S', help="Data directory")
+parser.add_argument("--cache_dir", default=os.path.normpath("./data/h3.6m/cache"), type=str, metavar='S', help="Directory of the preprocessed dataset cache. Empty to always read the .txt files")
+parser.add_argument("--data_workers", default=None, type=int, metavar='N', help="Processes used to parse the dataset files. Defaults to one per core")
+parser.add_argument("--preprocess", action='store_true', help="Only build the preprocessed dataset cache and exit")
+parser.add_argument("--distill", action='store_true', help="Train the model as a student of the teacher given by --teacher_checkpoint")
+parser.add_argument("--teacher_checkpoint", default="", type=str, metavar='S', help="Checkpoint of the teacher, with the same options as the student except --teacher_size and --teacher_architecture")
+parser.add_argument("--teacher_size", default=1024, type=int, metavar='N', help="Size of each layer of the teacher.")
+parser.add_argument("--teacher_architecture", default='tied', type=str, metavar='S', help="Seq2Seq architecture of the teacher: [basic, tied]")
+parser.add_argument("--distill_weight", default=0.5, type=float, metavar='N', help="Weight of the loss to the teacher predictions, the rest goes to the ground truth")
 parser.add_argument("--train_dir", default=os.path.normpath("./experiments/"), type=str, metavar='S', help="Training directory.")
 
 parser.add_argument("--action",default="all", type=str, metavar='S', help="The action to train on. all means all the actions, all_periodic means walking, eating and smoking")
@@ -47,7 +70,23 @@ parser.add_argument("--test_every", default=1000, type=int, metavar='N', help="H
 parser.add_argument("--save_every", default=1000, type=int, metavar='N', help="How often to compute error on the test set.")
 parser.add_argument("--show_every", default=100, type=int, metavar='N', help="How often to show error during training.")
 parser.add_argument("--sample", action='store_true' ,help="Set to True for sampling.")
+parser.add_argument("--num_samples", default=1, type=int, metavar='N', help="With a stochastic model, also draw this many trajectories per seed in --sample and report best-of-K and average errors")
+parser.add_argument("--sample_memory_mb", default=512, type=float, metavar='N', help="Memory budget of the trajectories decoded together with --num_samples")
+parser.add_argument("--export", action='store_true', help="Export the checkpoint given by --load and compare its outputs and latency with the eager model")
+parser.add_argument("--export_format", default="torchscript", choices=["torchscript", "onnx"], help="Format to export to")
+parser.add_argument("--backend", default="torch", choices=["torch", "onnx"], help="Run --sample, --quantize and the validation of training with the model, or with its ONNX export")
+parser.add_argument("--quantize", action='store_true', help="Quantize the checkpoint given by --load to INT8 and compare it with the fp32 model, on the CPU")
+parser.add_argument("--quantized", action='store_true', help="Load the INT8 checkpoint saved by --quantize instead of the fp32 one")
+parser.add_argument("--serve", action='store_true', help="Serve forecasts of the checkpoint given by --load to local clients")
+parser.add_argument("--serve_socket", default="", type=str, metavar='S', help="Unix socket to serve on. Empty to serve on --serve_port of localhost")
+parser.add_argument("--serve_port", default=8765, type=int, metavar='N', help="Localhost TCP port to serve on")
+parser.add_argument("--max_batch", default=64, type=int, metavar='N', help="Maximum number of requests in a micro-batch of the server")
+parser.add_argument("--max_wait_ms", default=5.0, type=float, metavar='N', help="Maximum time the server waits to fill a micro-batch")
+parser.add_argument("--stats_every", default=0, type=float, metavar='N', help="Print the server metrics every this many seconds. 0 to never print them")
 parser.add_argument("--use_cpu", action='store_true', help="Whether to use the CPU")
+parser.add_argument("--data_on_device", action='store_true', help="Keep the packed training data on the device")
+parser.add_argument("--prefetch", default=2, type=int, metavar='N', help="Number of training batches to prepare ahead in background threads. 0 to disable")
+parser.add_argument("--prefetch_workers", default=1, type=int, metavar='N', help="Number of threads preparing the training batches")
 parser.add_argument("--load", default=0, type=int, metavar='N', help="Try to load a previous checkpoint")
 ###params for IRL training###
 parser.add_argument("--irl_training", action="store_true", help="set to use IRL training scheme")
@@ -58,6 +97,8 @@ parser.add_argument("--discrim_lr", default = 0.005, type=float, metavar="N", he
 parser.add_argument("--discrim_hidden_size", default=1024, type=int, metavar='N', help= "hidden size of discriminator net")
 parser.add_argument("--discrim_num_layers", default=1, type=int, metavar="N", help="number of layers in the discriminator")
 parser.add_argument("--discrim_load", default=-1, type=int, metavar="N", help= "load pretrained model to discriminator")
+parser.add_argument("--replay_size", default=512, type=int, metavar="N", help="number of generated sequences kept to train the discriminator on. 0 to disable")
+parser.add_argument("--replay_ratio", default=0.5, type=float, metavar="N", help="number of replayed generated sequences per fresh one in a discriminator batch")
 parser.add_argument("--stochastic", action="store_true", help="use stochastic training approach")
 parser.add_argument("--skip_pretrain_policy", action="store_true", help="skip pretrain process of policy net")
 FLAGS = parser.parse_args()
@@ -74,6 +115,8 @@ train_dir = os.path.normpath(os.path.join( FLAGS.train_dir, FLAGS.action,
   'residual_vel' if FLAGS.residual_velocities else 'not_residual_vel',
   'irl_training' if FLAGS.irl_training else 'normal training',
   'stochastic_sampling' if FLAGS.stochastic else 'no sampling'))
+if FLAGS.distill:
+  train_dir = os.path.join( train_dir, 'distilled_from_{0}_{1}'.format(FLAGS.teacher_architecture, FLAGS.teacher_size) )
 
 summaries_dir = os.path.normpath(os.path.join( train_dir, "log" )) # Directory for TB summaries
 
@@ -95,7 +138,7 @@ def create_model(actions, sampling=False):
         device,
         not FLAGS.omit_one_hot,
         FLAGS.residual_velocities,
-        stochastic = True,
+        stochastic = FLAGS.stochastic or FLAGS.irl_training,
         dtype=torch.float32)
 
     discrim_net = discriminator.Discriminator(
@@ -111,9 +154,15 @@ def create_model(actions, sampling=False):
         print("Creating model with fresh parameters.")
         #TODO: Initial parameter here
         return policy_net, discrim_net
-    #Load model from iteration
-    if os.path.isfile(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(FLAGS.load))):
-        policy_net.load_state_dict(torch.load(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(FLAGS.load))))
+    #Load model from iteration, saved either by train() or by the pretraining of train_IRL()
+    if FLAGS.quantized:
+        if device.type != 'cpu':
+            raise ValueError("Quantized models only run on the CPU, use --use_cpu")
+        quantization.load_quantized(policy_net, os.path.join(train_dir, 'quantized-checkpoint-{0}.pt'.format(FLAGS.load)))
+    elif os.path.isfile(os.path.join(train_dir, 'checkpoint-{0}.pt'.format(FLAGS.load))):
+        policy_net.load_state_dict(torch.load(os.path.join(train_dir, 'checkpoint-{0}.pt'.format(FLAGS.load)), map_location=device))
+    elif os.path.isfile(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(FLAGS.load))):
+        policy_net.load_state_dict(torch.load(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(FLAGS.load)), map_location=device))
     elif FLAGS.load > 0:
         raise ValueError("Asked to load pretrain policy checkpoint {0}, but it does not seem to exist".format(FLAGS.load))
 
@@ -124,12 +173,81 @@ def create_model(actions, sampling=False):
 
     return policy_net, discrim_net
 
+def create_teacher(actions):
+    """
+    Load the teacher of a distillation. It shares all the options of the
+    student, except for its size and architecture.
+    """
+    if not os.path.isfile(FLAGS.teacher_checkpoint):
+        raise ValueError("Distillation needs a --teacher_checkpoint, {0} does not exist".format(FLAGS.teacher_checkpoint))
+    if FLAGS.stochastic or FLAGS.irl_training:
+        raise ValueError("Only deterministic models can be distilled")
+
+    teacher = seq2seq_model.Seq2SeqModel(
+        FLAGS.teacher_architecture,
+        FLAGS.seq_length_in,
+        FLAGS.seq_length_out,
+        FLAGS.teacher_size,
+        FLAGS.num_layers,
+        FLAGS.batch_size,
+        None,  # no summaries, they would go with the student's
+        "sampling_based",  # the teacher always feeds back its own predictions
+        len( actions ),
+        device,
+        not FLAGS.omit_one_hot,
+        FLAGS.residual_velocities,
+        dtype=torch.float32)
+    teacher.load_state_dict(torch.load(FLAGS.teacher_checkpoint, map_location=device))
+    teacher.eval().to(device)
+    for p in teacher.parameters():
+        p.requires_grad_(False)
+    return teacher
+
+def print_distillation_report(teacher, teacher_errors, student, student_errors):
+    """Compare the srnn errors and the per-frame latency of a student with its teacher"""
+    print()
+    print("== distillation: mean over actions ==")
+    print_srnn_errors(["teacher", "student"], np.stack([np.mean(teacher_errors, 0), np.mean(student_errors, 0)]))
+
+    print()
+    print("{0: <12} | {1: >14} | {2: >14} | {3: >8}".format("batch size", "teacher ms/frm", "student ms/frm", "speedup"))
+    forecasts = [create_forecaster(teacher, "torch"), create_forecaster(student, "torch")]
+    for batch_size in [1, 8, 32]:
+        encoder_input = torch.randn(student.source_seq_len-1, batch_size, student.input_size, device=device)
+        decoder_input = torch.randn(student.target_seq_len, batch_size, student.input_size, device=device)
+        teacher_ms, student_ms = [script_model.measure_latency(forecast, encoder_input, decoder_input) / student.target_seq_len
+                                  for forecast in forecasts]
+        print("{0: <12} | {1:14.3f} | {2:14.3f} | {3:7.2f}x".format(batch_size, teacher_ms, student_ms, teacher_ms / student_ms))
+    print("Parameters: {0} teacher, {1} student".format(
+        sum(p.numel() for p in teacher.parameters()), sum(p.numel() for p in student.parameters())))
+
+def create_samplers(model, train_set, test_set):
+    """
+    Create the batch samplers of the train and test sets for the model. Each
+    sampler gets its own RandomState seeded from np.random, so the training
+    batches do not depend on how far ahead they are prefetched.
+
+    Returns
+      train_batches: iterator of training batches, prefetched if FLAGS.prefetch > 0
+      test_sampler: BatchSampler of the test set
+    """
+    train_sampler = batch_sampler.BatchSampler(train_set, model.source_seq_len, model.target_seq_len,
+        model.batch_size, device, FLAGS.data_on_device, np.random.RandomState(np.random.randint(2**31 - 1)))
+    test_sampler = batch_sampler.BatchSampler(test_set, model.source_seq_len, model.target_seq_len,
+        model.batch_size, device, FLAGS.data_on_device, np.random.RandomState(np.random.randint(2**31 - 1)))
+
+    if FLAGS.prefetch > 0:
+        train_batches = batch_sampler.BatchPrefetcher(train_sampler, FLAGS.prefetch, FLAGS.prefetch_workers)
+    else:
+        train_batches = (train_sampler.get_batch() for _ in itertools.count())
+    return train_batches, test_sampler
+
 #TODO: train with the GAIL framework.
 def train_IRL():
     actions = define_actions(FLAGS.action)
     number_of_actions = len(actions)
     train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
-        actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot )
+        actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.cache_dir, FLAGS.data_workers )
     print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
     #There should be two net for the task
     policy_net, discrim_net = create_model(actions, sampling=False)
@@ -138,39 +256,210 @@ def train_IRL():
     discrim_net.to(device)
     print("Model created.")
 
-    # === Read and denormalize the gt with srnn's seeds, as we'll need them
-    # many times for evaluation in Euler Angles ===
-    srnn_gts_euler = get_srnn_gts( actions, policy_net, test_set, data_mean,
-                          data_std, dim_to_ignore, not FLAGS.omit_one_hot )
+    train_batches, test_sampler = create_samplers(policy_net, train_set, test_set)
+    try:
+        # === Read and denormalize the gt with srnn's seeds, as we'll need them
+        # many times for evaluation in Euler Angles ===
+        srnn_fixtures = load_srnn_fixtures( actions, policy_net, test_set, data_mean, data_std, dim_to_use )
 
 
-    ############################################################################
-    ################# Pretrain policy network ##################################
-    ############################################################################
-    if FLAGS.skip_pretrain_policy:
-        if not os.path.isfile(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt'.format(FLAGS.load))):
-            raise ValueError("the best policy checkpoint does not seem to exist".format(FLAGS.load))
-    else:
-        step_time, loss, val_loss, best_loss = 0.0, 0.0, 0.0, 0.0
-        # current_step = 0 if FLAGS.load <= 0 else FLAGS.load + 1
-        current_step = 0
+        ############################################################################
+        ################# Pretrain policy network ##################################
+        ############################################################################
+        if FLAGS.skip_pretrain_policy:
+            if not os.path.isfile(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt'.format(FLAGS.load))):
+                raise ValueError("the best policy checkpoint does not seem to exist".format(FLAGS.load))
+        else:
+            step_time, loss, val_loss, best_loss = 0.0, 0.0, 0.0, 0.0
+            # current_step = 0 if FLAGS.load <= 0 else FLAGS.load + 1
+            current_step = 0
 
+            previous_losses = []
+
+            step_time, loss = 0, 0
+            lr = FLAGS.learning_rate
+            optimizer = torch.optim.SGD(policy_net.parameters(), lr=lr)
+            for _ in xrange(FLAGS.iterations):
+
+                start_time = time.time()
+                encoder_inputs, decoder_inputs, decoder_outputs = next(train_batches)
+                policy_net.train()
+                means,stds, _ , _ = policy_net(encoder_inputs, decoder_inputs)
+                optimizer.zero_grad()
+                target = (decoder_outputs - decoder_inputs)[:,:,:policy_net.HUMAN_SIZE]
+                step_loss = policy_net.loss(means, stds, target)
+                step_loss.backward()
+                torch.nn.utils.clip_grad_norm_(policy_net.parameters(),FLAGS.max_gradient_norm)
+                optimizer.step()
+
+                if current_step % FLAGS.show_every == 0:
+                    print("step {0:04d}; step_loss: {1:.4f}".format(current_step, step_loss ))
+
+                step_time += (time.time() - start_time) / FLAGS.test_every
+                loss += step_loss / FLAGS.test_every
+                current_step += 1
+
+                ## step decay ##
+                if current_step % FLAGS.learning_rate_step == 0:
+                    lr *= FLAGS.learning_rate_decay_factor
+                    for g in optimizer.param_groups:
+                        g['lr'] = lr
+
+                ## Validation step ##
+                if current_step % FLAGS.test_every == 0:
+                    encoder_inputs, decoder_inputs, decoder_outputs = test_sampler.get_batch()
+                    policy_net.eval()
+                    means, stds, _, _= policy_net(encoder_inputs, decoder_inputs)
+                    target = (decoder_outputs - decoder_inputs)[:,:,:policy_net.HUMAN_SIZE]
+                    step_loss = policy_net.loss(means, stds, target)
+                    val_loss = step_loss
+                    print("traing generator, iter {0:04d}: val loss: {1:.4f}".format(current_step, val_loss))
+
+                # Save the best model
+                if best_loss == 0 or best_loss > val_loss:
+                    best_loss = val_loss
+                    torch.save(policy_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt')))
+
+                # Save the model periodically
+                if current_step % FLAGS.save_every == 0:
+                    print( "Saving the model..." ); start_time = time.time()
+                    torch.save(policy_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(current_step))))
+                    print( "done in {0:.2f} ms".format( (time.time() - start_time)*1000))
+
+                # Reset global time and loss
+                step_time, loss = 0, 0
+                sys.stdout.flush()
+
+        print ("policy net pretrain is done.")
+
+        ############################################################################
+        #########################   Start Adeversial Training ######################
+        ############################################################################
+
+        # load the best pretained policy
+        policy_state_dict = torch.load(os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt')))
+        policy_net.load_state_dict(policy_state_dict)
+        print("Load the best model for policy net")
+
+        # optimizer
+        optimizer_policy = torch.optim.Adam(policy_net.parameters(), lr=FLAGS.policy_lr)
+        optimizer_discrim = torch.optim.Adam(discrim_net.parameters(), lr=FLAGS.discrim_lr)
+        discrim_criterion = nn.BCELoss()
+        discrim_criterion.to(device)
+        discrim_net.train()
+        policy_net.eval()
+        # The discriminator is trained on rollouts generated without autograd, and
+        # on rollouts of earlier iterations kept in the replay buffer
+        replay = ReplayBuffer(FLAGS.replay_size)
+        ###pretrain discriminator
+        for i in range(FLAGS.train_discrim_iter):
+            encoder_inputs, decoder_inputs, decoder_outputs = next(train_batches)
+            with torch.no_grad():
+                _,_ , predict_seq , _ = policy_net(encoder_inputs, decoder_inputs)
+            expert_state, expert_action = get_state_action(encoder_inputs, decoder_inputs, decoder_outputs)
+            state, action = get_state_action(encoder_inputs, decoder_inputs, predict_seq)
+            num_fresh = state.shape[1]
+            state, action = replay.mix(state, action, FLAGS.replay_ratio)
+            pre_mod_p, pre_exp_p = update_discrim(3.0, discrim_net, optimizer_discrim, expert_state, expert_action, state, action, device, FLAGS.seq_length_in, num_fresh=num_fresh)
+            # The output on the expert sequences is only read back for logging
+            mod_p = pre_mod_p.item()
+            if (i+1) % FLAGS.show_every == 0:
+                print("train discriminator: iter {0}; exp: {1:.4f}; mod: {2:.4f}".format(i+1, pre_exp_p.item(), mod_p))
+            if mod_p < 0.3:
+                break
+
+        # Save pretrain discriminator model
+        torch.save(discrim_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-discrim-checkpoint.pt')))
+
+        print ("Discrim net pretrain is done.")
+
+        #####################################################################
+        ########################### GAN training ############################
+        #####################################################################
+        discrim_net.train()
+        policy_net.train()
+        for i_iter in range(FLAGS.train_GAN_iter):
+            # ts0 = time.time()
+            encoder_inputs, decoder_inputs, decoder_outputs = next(train_batches)
+            with torch.no_grad():
+                _,_ , predict_seq , _ = policy_net(encoder_inputs, decoder_inputs)
+            expert_state, expert_action = get_state_action(encoder_inputs, decoder_inputs, decoder_outputs)
+            state, action = get_state_action(encoder_inputs, decoder_inputs, predict_seq)
+            num_fresh = state.shape[1]
+            state, action = replay.mix(state, action, FLAGS.replay_ratio)
+            # ts1 = time.time()
+
+            # t0 = time.time()
+            pre_mod_p, pre_exp_p = update_discrim(2.0, discrim_net, optimizer_discrim, expert_state, expert_action, state, action, device, FLAGS.seq_length_in, num_fresh=num_fresh)
+            mod_p = pre_mod_p.item()
+
+            #update policy network, through a rollout of its own as the one above has no graph
+            if i_iter > 3 and mod_p < 0.8:
+                _,_ , predict_seq , _ = policy_net(encoder_inputs, decoder_inputs)
+                state, action = get_state_action(encoder_inputs, decoder_inputs, predict_seq)
+                update_policy(policy_net, optimizer_policy, discrim_net, discrim_criterion, state, action,FLAGS.seq_length_in,10.0, device)
+            t1 = time.time()
+
+            if (i_iter + 1) % FLAGS.show_every == 0:
+                print("train discriminator: iter {0}; exp: {1:.4f}; mod: {2:.4f}".format(i_iter+1, pre_exp_p.item(), mod_p))
+
+            if (i_iter + 1) % FLAGS.save_every == 0:
+                os.path.normpath(os.path.join(train_dir, 'policy-checkpoint-{0}.pt'.format(i_iter + 1)))
+                os.path.normpath(os.path.join(train_dir, 'discrim-checkpoint-{0}.pt'.format(i_iter + 1)))
+    finally:
+        train_batches.close()
+
+def train():
+    actions = define_actions(FLAGS.action)
+    number_of_actions = len(actions)
+    train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
+        actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.cache_dir, FLAGS.data_workers )
+
+    print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
+    model, _ = create_model(actions,sampling=False)
+    model.to(device)
+    print("Model created")
+
+    train_batches, test_sampler = create_samplers(model, train_set, test_set)
+    try:
+        # === Read and denormalize the gt with srnn's seeds, as we'll need them
+        # many times for evaluation in Euler Angles ===
+        # They are kept on the device with the normalization stats, so that the
+        # whole evaluation runs there and the errors come back in a single host sync
+        srnn_fixtures = load_srnn_fixtures( actions, model, test_set, data_mean, data_std, dim_to_use )
+
+        if FLAGS.distill:
+            teacher = create_teacher(actions)
+            teacher_errors, _, _ = evaluate_srnn( teacher, srnn_fixtures )
+            print("Teacher loaded from {0}".format(FLAGS.teacher_checkpoint))
+            print_srnn_errors( actions, teacher_errors )
+
+        #=== This is the training loop ===
+        step_time, loss, val_loss = 0.0, 0.0, 0.0
+        current_step = 0 if FLAGS.load <= 0 else FLAGS.load + 1
         previous_losses = []
 
         step_time, loss = 0, 0
         lr = FLAGS.learning_rate
-        optimizer = torch.optim.SGD(policy_net.parameters(), lr=lr)
+        optimizer = torch.optim.SGD(model.parameters(), lr=lr)
         for _ in xrange(FLAGS.iterations):
 
             start_time = time.time()
-            encoder_inputs, decoder_inputs, decoder_outputs = policy_net.get_batch(train_set, not FLAGS.omit_one_hot)
-            policy_net.train()
-            means,stds, _ , _ = policy_net(transform(encoder_inputs), transform(decoder_inputs))
+            encoder_inputs, decoder_inputs, decoder_outputs = next(train_batches)
+
+            model.train()
+            output, _ = model(encoder_inputs, decoder_inputs)
             optimizer.zero_grad()
-            target = (transform(decoder_outputs) -transform(decoder_inputs))[:,:,:policy_net.HUMAN_SIZE]
-            step_loss = policy_net.loss(means, stds, target)
+
+            step_loss = model.loss(output[:,:,:model.HUMAN_SIZE], decoder_outputs[:,:,:model.HUMAN_SIZE])
+            if FLAGS.distill:
+                # Also match the rollouts of the teacher on the same batch
+                with torch.no_grad():
+                    teacher_output, _ = teacher(encoder_inputs, decoder_inputs)
+                step_loss = ((1 - FLAGS.distill_weight) * step_loss +
+                             FLAGS.distill_weight * model.loss(output[:,:,:model.HUMAN_SIZE], teacher_output[:,:,:model.HUMAN_SIZE]))
             step_loss.backward()
-            torch.nn.utils.clip_grad_norm_(policy_net.parameters(),FLAGS.max_gradient_norm)
+            torch.nn.utils.clip_grad_norm_(model.parameters(),FLAGS.max_gradient_norm)
             optimizer.step()
 
             if current_step % FLAGS.show_every == 0:
@@ -188,286 +477,190 @@ def train_IRL():
 
             ## Validation step ##
             if current_step % FLAGS.test_every == 0:
-                encoder_inputs, decoder_inputs, decoder_outputs = policy_net.get_batch(test_set, not FLAGS.omit_one_hot)
-                policy_net.eval()
-                means, stds, _, _= policy_net(transform(encoder_inputs), transform(decoder_inputs))
-                target = (transform(decoder_outputs) - transform(decoder_inputs))[:,:,:policy_net.HUMAN_SIZE]
-                step_loss = policy_net.loss(means, stds, target)
+                encoder_inputs, decoder_inputs, decoder_outputs = test_sampler.get_batch()
+                ##TODO: a forward pass
+                model.eval()
+                output, _ = model(encoder_inputs, decoder_inputs)
+                step_loss = model.loss(output[:,:,:model.HUMAN_SIZE],decoder_outputs[:,:,:model.HUMAN_SIZE])
                 val_loss = step_loss
-                print("traing generator, iter {0:04d}: val loss: {1:.4f}".format(current_step, val_loss))
-
-            # Save the best model
-            if best_loss == 0 or best_loss > val_loss:
-                best_loss = val_loss
-                torch.save(policy_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt')))
-
-            # Save the model periodically
-            if current_step % FLAGS.save_every == 0:
-                print( "Saving the model..." ); start_time = time.time()
-                torch.save(policy_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-{0}.pt'.format(current_step))))
-                print( "done in {0:.2f} ms".format( (time.time() - start_time)*1000))
-
-            # Reset global time and loss
-            step_time, loss = 0, 0
-            sys.stdout.flush()
-
-    print ("policy net pretrain is done.")
-
-    ############################################################################
-    #########################   Start Adeversial Training ######################
-    ############################################################################
-
-    # load the best pretained policy
-    policy_state_dict = torch.load(os.path.normpath(os.path.join(train_dir, 'pretrain-policy-checkpoint-best.pt')))
-    policy_net.load_state_dict(policy_state_dict)
-    print("Load the best model for policy net")
-
-    # optimizer
-    optimizer_policy = torch.optim.Adam(policy_net.parameters(), lr=FLAGS.policy_lr)
-    optimizer_discrim = torch.optim.Adam(discrim_net.parameters(), lr=FLAGS.discrim_lr)
-    discrim_criterion = nn.BCELoss()
-    discrim_criterion.to(device)
-    discrim_net.train()
-    policy_net.eval()
-    ###pretrain discriminator
-    for i in range(FLAGS.train_discrim_iter):
-        encoder_inputs, decoder_inputs, decoder_outputs = policy_net.get_batch(train_set, not FLAGS.omit_one_hot)
-        _,_ , predict_seq , _ = policy_net(transform(encoder_inputs), transform(decoder_inputs))
-        expert_state, expert_action = get_state_action(transform(encoder_inputs), transform(decoder_inputs), transform(decoder_outputs))
-        state, action = get_state_action(transform(encoder_inputs), transform(decoder_inputs), predict_seq)
-        pre_mod_p, pre_exp_p = update_discrim(3.0, discrim_net, optimizer_discrim, discrim_criterion, expert_state, expert_action, state, action, device, FLAGS.seq_length_in)
-        if (i+1) % FLAGS.show_every == 0:
-            print("train discriminator: iter ", (i+1), ' exp: ', pre_exp_p, ' mod: ', pre_mod_p)
-        if pre_mod_p < 0.3:
-            break
-
-    # Save pretrain discriminator model
-    torch.save(discrim_net.state_dict(), os.path.normpath(os.path.join(train_dir, 'pretrain-discrim-checkpoint.pt')))
-
-    print ("Discrim net pretrain is done.")
-
-    #####################################################################
-    ########################### GAN training ############################
-    #####################################################################
-    discrim_net.train()
-    policy_net.train()
-    exp_p = []
-    mod_p = []
-    for i_iter in range(FLAGS.train_GAN_iter):
-        # ts0 = time.time()
-        encoder_inputs, decoder_inputs, decoder_outputs = policy_net.get_batch(train_set, not FLAGS.omit_one_hot)
-        _,_ , predict_seq , _ = policy_net(transform(encoder_inputs), transform(decoder_inputs))
-        expert_state, expert_action = get_state_action(transform(encoder_inputs), transform(decoder_inputs), transform(decoder_outputs))
-        state, action = get_state_action(transform(encoder_inputs), transform(decoder_inputs), predict_seq)
-        # ts1 = time.time()
-
-        # t0 = time.time()
-        pre_mod_p, pre_exp_p = update_discrim(2.0, discrim_net, optimizer_discrim, discrim_criterion, expert_state, expert_action, state, action, device, FLAGS.seq_length_in)
-
-        exp_p.append(pre_exp_p)
-        mod_p.append(pre_mod_p)
-
-        #update policy network
-        if i_iter > 3 and mod_p[-1] < 0.8:
-            update_policy(policy_net, optimizer_policy, discrim_net, discrim_criterion, state, action,FLAGS.seq_length_in,10.0, device)
-        t1 = time.time()
-
-        if (i_iter + 1) % FLAGS.show_every == 0:
-            print("train discriminator: iter ", (i_iter+1), ' exp: ', pre_exp_p, ' mod: ', pre_mod_p)
-
-        if (i_iter + 1) % FLAGS.save_every == 0:
-            os.path.normpath(os.path.join(train_dir, 'policy-checkpoint-{0}.pt'.format(i_iter + 1)))
-            os.path.normpath(os.path.join(train_dir, 'discrim-checkpoint-{0}.pt'.format(i_iter + 1)))
-
-def train():
-    actions = define_actions(FLAGS.action)
-    number_of_actions = len(actions)
-    train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
-        actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot )
-
-    print("Creating %d layers of %d units." % (FLAGS.num_layers, FLAGS.size))
-    model = create_model(actions,sampling=False)
-    model.to(device)
-    print("Model created")
-
-    # === Read and denormalize the gt with srnn's seeds, as we'll need them
-    # many times for evaluation in Euler Angles ===
-    srnn_gts_euler = get_srnn_gts( actions, model, test_set, data_mean,
-                              data_std, dim_to_ignore, not FLAGS.omit_one_hot )
-
-
-
-    #=== This is the training loop ===
-    step_time, loss, val_loss = 0.0, 0.0, 0.0
-    current_step = 0 if FLAGS.load <= 0 else FLAGS.load + 1
-    previous_losses = []
-
-    step_time, loss = 0, 0
-    lr = FLAGS.learning_rate
-    optimizer = torch.optim.SGD(model.parameters(), lr=lr)
-    for _ in xrange(FLAGS.iterations):
+                # === Validation with srnn's seeds ===
+                mean_mean_errors, srnn_loss, mean_mpjpe = evaluate_srnn( model, srnn_fixtures,
+                                                                         create_eval_forecaster(model, current_step) )
+                print()
+                print_srnn_errors( actions, mean_mean_errors )
+                print()
+                print("3d joint position error (mm)")
+                print_srnn_errors( actions, mean_mpjpe, fmt="{0:5.1f}" )
+                print()
+                print("============================\n"
+                      "Global step:         %d\n"
+                      "Learning rate:       %.4f\n"
+                      "Step-time (ms):     %.4f\n"
+                      "Train loss avg:      %.4f\n"
+                      "--------------------------\n"
+                      "Val loss:            %.4f\n"
+                      "srnn loss:           %.4f\n"
+                      "============================" % (current_step,
+                      lr, step_time*1000, loss,
+                      val_loss, srnn_loss))
+                print()
 
-        start_time = time.time()
-        encoder_inputs, decoder_inputs, decoder_outputs = model.get_batch(train_set, not FLAGS.omit_one_hot )
+                previous_losses.append(loss)
 
-        model.train()
-        output, _ = model(transform(encoder_inputs), transform(decoder_inputs))
-        optimizer.zero_grad()
+                # Save the model
+                if current_step % FLAGS.save_every == 0:
+                  print( "Saving the model..." ); start_time = time.time()
+                  torch.save(model.state_dict(), os.path.normpath(os.path.join(train_dir, 'checkpoint-{0}.pt'.format(current_step))))
+                  print( "done in {0:.2f} ms".format( (time.time() - start_time)*1000) )
 
-        step_loss = model.loss(output[:,:,:model.HUMAN_SIZE], transform(decoder_outputs)[:,:,:model.HUMAN_SIZE])
-        step_loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(),FLAGS.max_gradient_norm)
-        optimizer.step()
+                # Reset global time and loss
+                step_time, loss = 0, 0
 
-        if current_step % FLAGS.show_every == 0:
-            print("step {0:04d}; step_loss: {1:.4f}".format(current_step, step_loss ))
+                sys.stdout.flush()
 
-        step_time += (time.time() - start_time) / FLAGS.test_every
-        loss += step_loss / FLAGS.test_every
-        current_step += 1
+        if FLAGS.distill:
+            model.eval()
+            student_errors, _, _ = evaluate_srnn( model, srnn_fixtures )
+            print_distillation_report( teacher, teacher_errors, model, student_errors )
+    finally:
+        train_batches.close()
 
-        ## step decay ##
-        if current_step % FLAGS.learning_rate_step == 0:
-            lr *= FLAGS.learning_rate_decay_factor
-            for g in optimizer.param_groups:
-                g['lr'] = lr
+def evaluate_srnn( model, fixtures, forecast=None ):
+  """
+  Euler angle and 3d joint position errors of a model on srnn's seeds.
 
-        ## Validation step ##
-        if current_step % FLAGS.test_every == 0:
-            encoder_inputs, decoder_inputs, decoder_outputs = model.get_batch(test_set, not FLAGS.omit_one_hot )
-            ##TODO: a forward pass
-            model.eval()
-            output, _ = model(transform(encoder_inputs), transform(decoder_inputs))
-            step_loss = model.loss(output[:,:,:model.HUMAN_SIZE],transform(decoder_outputs)[:,:,:model.HUMAN_SIZE])
-            val_loss = step_loss
-            print()
-            print("{0: <16} |".format("milliseconds"), end="")
-            for ms in [80, 160, 320, 400, 560, 1000]:
-                print(" {0:5d} |".format(ms), end="")
-            print()
-
-            # === Validation with srnn's seeds ===
-            for action in actions:
-                # Evaluate the model on the test batches
-                encoder_inputs, decoder_inputs, decoder_outputs = model.get_batch_srnn(test_set, action)
-                srnn_poses, _ = model(transform(encoder_inputs), transform(decoder_inputs))
-                srnn_loss = model.loss(srnn_poses[:,:,:model.HUMAN_SIZE],transform(decoder_outputs)[:,:,:model.HUMAN_SIZE])
-                # Denormalize the output
-                srnn_pred_expmap = data_utils.revert_output_format(srnn_poses.cpu().detach().numpy(),
-                  data_mean, data_std, dim_to_ignore, actions, not FLAGS.omit_one_hot )
-
-                # Save the errors here
-                mean_errors = np.zeros( (len(srnn_pred_expmap), srnn_pred_expmap[0].shape[0]) )
-
-                # Training is done in exponential map, but the error is reported in
-                # Euler angles, as in previous work.
-                # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-247769197
-                N_SEQUENCE_TEST = 8
-                for i in np.arange(N_SEQUENCE_TEST):
-                  eulerchannels_pred = srnn_pred_expmap[i]
-
-                  # Convert from exponential map to Euler angles
-                  for j in np.arange( eulerchannels_pred.shape[0] ):
-                    for k in np.arange(3,97,3):
-                      eulerchannels_pred[j,k:k+3] = data_utils.rotmat2euler(
-                        data_utils.expmap2rotmat( eulerchannels_pred[j,k:k+3] ))
-
-                  # The global translation (first 3 entries) and global rotation
-                  # (next 3 entries) are also not considered in the error, so the_key
-                  # are set to zero.
-                  # See https://github.com/asheshjain399/RNNexp/issues/6#issuecomment-249404882
-                  gt_i=np.copy(srnn_gts_euler[action][i])
-                  gt_i[:,0:6] = 0
-                  # Now compute the l2 error. The following is numpy port of the error
-                  # function provided by Ashesh Jain (in matlab), available at
-                  # https://github.com/asheshjain399/RNNexp/blob/srnn/structural_rnn/CRFProblems/H3.6m/dataParser/Utils/motionGenerationError.m#L40-L54
-                  idx_to_use = np.where( np.std( gt_i, 0 ) > 1e-4 )[0]
-
-                  euc_error = np.power( gt_i[:,idx_to_use] - eulerchannels_pred[:,idx_to_use], 2)
-                  euc_error = np.sum(euc_error, 1)
-                  euc_error = np.sqrt( euc_error )
-                  mean_errors[i,:] = euc_error
-
-                # This is simply the mean error over the N_SEQUENCE_TEST examples
-                mean_mean_errors = np.mean( mean_errors, 0 )
-
-                # Pretty print of the results for 80, 160, 320, 400, 560 and 1000 ms
-                print("{0: <16} |".format(action), end="")
-                for ms in [1,3,7,9,13,24]:
-                  if FLAGS.seq_length_out >= ms+1:
-                    print(" {0:.3f} |".format( mean_mean_errors[ms] ), end="")
-                  else:
-                    print("   n/a |", end="")
-                print()
+  Args
+    model: the model to evaluate, in eval mode
+    fixtures: SRNNFixtures of the test set, on the device of the model
+    forecast: function predicting the frames of a batch, see create_forecaster.
+      Runs the model itself if None.
+  Returns
+    mean_mean_errors: (len(actions), seq_length_out) array with the mean error
+      of each action at each frame
+    srnn_loss: loss of the model on the seeds of the last action
+    mean_mpjpe: (len(actions), seq_length_out) array with the mean per joint
+      position error in millimeters of each action at each frame
+  """
+  if forecast is None:
+    forecast = create_forecaster(model, "torch")
+
+  # The seeds of all the actions go through the model in a single batch
+  with torch.no_grad():
+    srnn_poses = forecast( fixtures.encoder_inputs, fixtures.decoder_inputs )
+    last_action = fixtures.rows( fixtures.actions[-1] )
+    srnn_loss = nn.MSELoss(reduction='mean')( srnn_poses[:,last_action,:model.HUMAN_SIZE],
+                                              fixtures.decoder_outputs[:,last_action,:model.HUMAN_SIZE] )
+    one_hot, number_of_actions = model.input_size > model.HUMAN_SIZE, model.input_size - model.HUMAN_SIZE
+    mean_mean_errors = evaluation.srnn_errors( srnn_poses, fixtures.gts_euler_t, fixtures.data_mean,
+      fixtures.data_std, fixtures.dim_to_use, one_hot, number_of_actions )
+    mean_mpjpe = evaluation.srnn_mpjpe( srnn_poses, fixtures.gts_xyz, fixtures.data_mean,
+      fixtures.data_std, fixtures.dim_to_use, one_hot, number_of_actions, fixtures.fk )
+
+  # A single copy back to the host for all the actions
+  errors = torch.stack( [mean_mean_errors, mean_mpjpe] ).cpu().numpy()
+  return errors[0], srnn_loss, errors[1]
+
+
+def evaluate_best_of_k( model, encoder_inputs, decoder_inputs, gts_euler, data_mean, data_std, dim_to_use, num_samples, memory_mb,
+                        write_samples=None, forecast=None ):
+  """
+  Euler angle errors of many trajectories drawn by a stochastic model for each
+  sequence of a batch. The trajectories are decoded and scored in chunks of
+  samples, so that the memory they need stays within memory_mb. Each chunk is
+  handed to write_samples and then dropped, none of them are kept. The
+  dimensions are picked on each trajectory, as for the errors of sample().
 
-            print()
-            print("============================\n"
-                  "Global step:         %d\n"
-                  "Learning rate:       %.4f\n"
-                  "Step-time (ms):     %.4f\n"
-                  "Train loss avg:      %.4f\n"
-                  "--------------------------\n"
-                  "Val loss:            %.4f\n"
-                  "srnn loss:           %.4f\n"
-                  "============================" % (current_step,
-                  lr, step_time*1000, loss,
-                  val_loss, srnn_loss))
-            print()
-
-            previous_losses.append(loss)
-
-            # Save the model
-            if current_step % FLAGS.save_every == 0:
-              print( "Saving the model..." ); start_time = time.time()
-              torch.save(model.state_dict(), os.path.normpath(os.path.join(train_dir, 'checkpoint-{0}.pt'.format(current_step))))
-              print( "done in {0:.2f} ms".format( (time.time() - start_time)*1000) )
-
-            # Reset global time and loss
-            step_time, loss = 0, 0
+  Args
+    model: the stochastic model, in eval mode
+    encoder_inputs: (source_seq_len-1) * batch * input_size tensor
+    decoder_inputs: seq * batch * input_size tensor
+    gts_euler: (batch, seq_length_out, 99) tensor with the ground truths in Euler angles
+    data_mean: d-long tensor with the mean of the training data, on the device
+    data_std: d-long tensor with the standard deviation of the training data, on the device
+    dim_to_use: tensor with the dimensions used by the model
+    num_samples: number of trajectories drawn for each sequence (K)
+    memory_mb: memory budget of a chunk of trajectories, in MB
+    write_samples: function called with the index of the first trajectory of a
+      chunk and a (batch, k, seq_length_out, 99) array with the un-normalized
+      trajectories of the chunk in exponential map, or None
+    forecast: function predicting the frames of a batch, see create_forecaster,
+      run on the sequences repeated k times for a chunk. The chunks are drawn
+      with model.sample_many, which encodes the sequences once, if None.
+  Returns
+    best_errors: seq_length_out array with the error of the best of the K
+      samples at each frame, averaged over the sequences
+    average_errors: seq_length_out array with the error averaged over the
+      samples and the sequences
+  """
+  batch_size = encoder_inputs.shape[1]
+  target_seq_len = model.target_seq_len
+
+  # Rough size of a trajectory: the decoder outputs in float32, then the poses,
+  # rotation matrices and Euler angles (with temporaries) in float64
+  trajectory_bytes = target_seq_len * (4 * (model.input_size + 2 * model.HUMAN_SIZE) + 8 * 4 * (99 + 32 * 9))
+  chunk_size = max( 1, int(memory_mb * 2**20 // (trajectory_bytes * batch_size)) )
+
+  if forecast is None:
+    chunks = model.sample_many( encoder_inputs, decoder_inputs, num_samples, chunk_size )
+  else:
+    chunks = (forecast( encoder_inputs.repeat(1, k, 1), decoder_inputs.repeat(1, k, 1) )
+              for k in [min(chunk_size, num_samples - start) for start in range(0, num_samples, chunk_size)])
+
+  best_errors, sum_errors, start = None, 0, 0
+  with torch.no_grad():
+    for chunk in chunks:
+      k = chunk.shape[1] // batch_size
+      pred_expmap = torch_utils.revert_output_format( chunk, data_mean, data_std, dim_to_use,
+        model.input_size > model.HUMAN_SIZE, model.input_size - model.HUMAN_SIZE )
+      errors = torch_utils.euler_error( torch_utils.expmap2euler_channels( pred_expmap ),
+                                        gts_euler.repeat(k, 1, 1), mask_on_pred=True ).view( k, batch_size, target_seq_len )
+
+      chunk_best = torch.min( errors, 0 )[0]
+      best_errors = chunk_best if best_errors is None else torch.min( best_errors, chunk_best )
+      sum_errors = sum_errors + torch.sum( errors, 0 )
+      if write_samples is not None:
+        write_samples( start, pred_expmap.view( k, batch_size, target_seq_len, -1 ).transpose( 0, 1 ).cpu().numpy() )
+      start += k
+
+  errors = torch.stack( [torch.mean(best_errors, 0), torch.mean(sum_errors / num_samples, 0)] ).cpu().numpy()
+  return errors[0], errors[1]
+
+
+def print_srnn_errors( actions, mean_mean_errors, fmt="{0:.3f}" ):
+  """Pretty print of the errors returned by evaluate_srnn at 80, 160, 320, 400, 560 and 1000 ms"""
+  print("{0: <16} |".format("milliseconds"), end="")
+  for ms in [80, 160, 320, 400, 560, 1000]:
+    print(" {0:5d} |".format(ms), end="")
+  print()
+
+  for action_idx, action in enumerate(actions):
+    print("{0: <16} |".format(action), end="")
+    for ms in [1,3,7,9,13,24]:
+      if mean_mean_errors.shape[1] >= ms+1:
+        print(" " + fmt.format( mean_mean_errors[action_idx, ms] ) + " |", end="")
+      else:
+        print("   n/a |", end="")
+    print()
 
-            sys.stdout.flush()
 
-def get_srnn_gts( actions, model, test_set, data_mean, data_std, dim_to_ignore, one_hot, to_euler=True ):
+def load_srnn_fixtures( actions, model, test_set, data_mean, data_std, dim_to_use ):
   """
-  Get the ground truths for srnn's sequences, and convert to Euler angles.
-  (the error is always computed in Euler angles).
+  Get srnn's seeds and their ground truths, denormalized in exponential map
+  and in Euler angles (the error is always computed in Euler angles). They are
+  prepared once per dataset and cached next to the dataset cache.
 
   Args
-    actions: a list of actions to get ground truths for.
-    model: training model we are using (we only use the "get_batch" method).
-    test_set: dictionary with normalized training data.
+    actions: a list of actions to get the seeds of.
+    model: training model we are using (we only use the sequence lengths and the "get_batch_srnn" method).
+    test_set: dictionary with normalized test data.
     data_mean: d-long vector with the mean of the training data.
     data_std: d-long vector with the standard deviation of the training data.
-    dim_to_ignore: dimensions that we are not using to train/predict.
-    one_hot: whether the data comes with one-hot encoding indicating action.
-    to_euler: whether to convert the angles to Euler format or keep thm in exponential map
-
+    dim_to_use: dimensions that we are using to train/predict.
   Returns
-    srnn_gts_euler: a dictionary where the keys are actions, and the values
-      are the ground_truth, denormalized expected outputs of srnns's seeds.
+    srnn_fixtures: evaluation.SRNNFixtures on the device
   """
-  srnn_gts_euler = {}
-
-  for action in actions:
-
-    srnn_gt_euler = []
-    _, _, srnn_expmap = model.get_batch_srnn( test_set, action )
-
-    # expmap -> rotmat -> euler
-    for i in np.arange( srnn_expmap.shape[0] ):
-      denormed = data_utils.unNormalizeData(srnn_expmap[i,:,:], data_mean, data_std, dim_to_ignore, actions, one_hot )
-
-      if to_euler:
-        for j in np.arange( denormed.shape[0] ):
-          for k in np.arange(3,97,3):
-            denormed[j,k:k+3] = data_utils.rotmat2euler( data_utils.expmap2rotmat( denormed[j,k:k+3] ))
-
-      srnn_gt_euler.append( denormed );
-
-    # Put back in the dictionary
-    srnn_gts_euler[action] = srnn_gt_euler
-
-  return srnn_gts_euler
+  return evaluation.load_fixtures( model, test_set, actions, data_mean, data_std, dim_to_use,
+                                   not FLAGS.omit_one_hot, FLAGS.cache_dir, device )
 
 
 def sample():
@@ -481,65 +674,57 @@ def sample():
   sampling = True
   model, _ = create_model(actions, sampling=True)
   model.eval().to(device)
+  forecast = create_forecaster(model, FLAGS.backend)
   print("Model created")
 
   # Load all the data
   train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
-    actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot )
+    actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.cache_dir, FLAGS.data_workers )
 
   # === Read and denormalize the gt with srnn's seeds, as we'll need them
   # many times for evaluation in Euler Angles ===
-  srnn_gts_expmap = get_srnn_gts( actions, model, test_set, data_mean,
-                            data_std, dim_to_ignore, not FLAGS.omit_one_hot, to_euler=False )
-  srnn_gts_euler = get_srnn_gts( actions, model, test_set, data_mean,
-                            data_std, dim_to_ignore, not FLAGS.omit_one_hot )
+  srnn_fixtures = load_srnn_fixtures( actions, model, test_set, data_mean, data_std, dim_to_use )
+
+  #Make prediction with srnn's seeds, of all the actions in a single batch
+  with torch.no_grad():
+      all_srnn_poses = forecast(srnn_fixtures.encoder_inputs, srnn_fixtures.decoder_inputs)
 
-  # Clean and create a new h5 file of samples
+  all_srnn_pred_expmap = np.array( data_utils.revert_output_format(all_srnn_poses.cpu().detach().numpy(), data_mean, data_std, dim_to_ignore, actions, not FLAGS.omit_one_hot) )
+
+  # The 3d points of all the samples, as they are visualized
+  all_xyz_gt, all_xyz_pred = forward_kinematics.canonical_xyz( srnn_fixtures.gts_expmap, all_srnn_pred_expmap )
+
+  # Create a new h5 file of samples, which stays open for the whole run
   SAMPLES_FNAME = 'samples.h5'
-  try:
-    os.remove( SAMPLES_FNAME )
-  except OSError:
-    pass
+  with sample_store.SampleWriter( SAMPLES_FNAME, actions, evaluation.SEEDS_PER_ACTION ) as store:
 
-  for action in actions:
+    # Save the ground truths and predictions of all the seeds, and their 3d points
+    store.write( 'expmap/gt', srnn_fixtures.gts_expmap )
+    store.write( 'expmap/preds', all_srnn_pred_expmap )
+    store.write( 'xyz/gt', all_xyz_gt.astype( np.float32 ) )
+    store.write( 'xyz/preds', all_xyz_pred.astype( np.float32 ) )
 
-      #Make prediction with srnn's seeds
-      encoder_inputs, decoder_inputs, decoder_outputs = model.get_batch_srnn(test_set, action)
-      if not FLAGS.stochastic:
-          srnn_poses, _ = model(transform(encoder_inputs), transform(decoder_inputs))
-      else:
-          _,_,srnn_poses,_ = model(transform(encoder_inputs), transform(decoder_inputs))
-      srnn_loss = nn.MSELoss(reduction='mean')(srnn_poses, transform(decoder_outputs))
-      srnn_pred_expmap = data_utils.revert_output_format(srnn_poses.cpu().detach().numpy(), data_mean, data_std, dim_to_ignore, actions, not FLAGS.omit_one_hot)
-
-      # Save the samples
-      with h5py.File( SAMPLES_FNAME, 'a' ) as hf:
-        for i in np.arange(8):
-          # Save conditioning ground truth
-          node_name = 'expmap/gt/{1}_{0}'.format(i, action)
-          hf.create_dataset( node_name, data=srnn_gts_expmap[action][i] )
-          # Save prediction
-          node_name = 'expmap/preds/{1}_{0}'.format(i, action)
-          hf.create_dataset( node_name, data=srnn_pred_expmap[i] )
+    for action in actions:
+
+      seeds = srnn_fixtures.rows(action)
+      srnn_poses = all_srnn_poses[:, seeds]
+      srnn_loss = nn.MSELoss(reduction='mean')(srnn_poses, srnn_fixtures.decoder_outputs[:, seeds])
+      srnn_pred_expmap = all_srnn_pred_expmap[seeds]
 
       # Compute and save the errors here
       mean_errors = np.zeros( (len(srnn_pred_expmap), srnn_pred_expmap[0].shape[0]) )
+      srnn_pred_euler = data_utils.expmap2euler_channels( np.array( srnn_pred_expmap ) )
 
       for i in np.arange(8):
 
-        eulerchannels_pred = srnn_pred_expmap[i]
-
-        for j in np.arange( eulerchannels_pred.shape[0] ):
-          for k in np.arange(3,97,3):
-            eulerchannels_pred[j,k:k+3] = data_utils.rotmat2euler(
-              data_utils.expmap2rotmat( eulerchannels_pred[j,k:k+3] ))
+        eulerchannels_pred = srnn_pred_euler[i]
 
         eulerchannels_pred[:,0:6] = 0
 
         # Pick only the dimensions with sufficient standard deviation. Others are ignored.
         idx_to_use = np.where( np.std( eulerchannels_pred, 0 ) > 1e-4 )[0]
 
-        euc_error = np.power( srnn_gts_euler[action][i][:,idx_to_use] - eulerchannels_pred[:,idx_to_use], 2)
+        euc_error = np.power( srnn_fixtures.gts_euler[seeds][i][:,idx_to_use] - eulerchannels_pred[:,idx_to_use], 2)
         euc_error = np.sum(euc_error, 1)
         euc_error = np.sqrt( euc_error )
         mean_errors[i,:] = euc_error
@@ -548,12 +733,203 @@ def sample():
       print( action )
       print( ','.join(map(str, mean_mean_errors.tolist() )) )
 
-      with h5py.File( SAMPLES_FNAME, 'a' ) as hf:
-        node_name = 'mean_{0}_error'.format( action )
-        hf.create_dataset( node_name, data=mean_mean_errors )
+      store.write_errors( 'mean', action, mean_mean_errors )
+
+      if FLAGS.num_samples > 1:
+        # Draw many trajectories per seed, and score the best one and the average.
+        # The trajectories are written to expmap/samples, (seeds, num_samples, seq_length_out, 99),
+        # a chunk at a time
+        def write_samples( start, samples ):
+          store.write_draws( 'expmap/samples', action, start, samples, FLAGS.num_samples )
+
+        best_errors, average_errors = evaluate_best_of_k( model,
+          srnn_fixtures.encoder_inputs[:, seeds], srnn_fixtures.decoder_inputs[:, seeds], srnn_fixtures.gts_euler_t[seeds],
+          srnn_fixtures.data_mean, srnn_fixtures.data_std, srnn_fixtures.dim_to_use, FLAGS.num_samples, FLAGS.sample_memory_mb,
+          write_samples, None if FLAGS.backend == "torch" else forecast )
+        print( "best of {0}".format(FLAGS.num_samples) )
+        print( ','.join(map(str, best_errors.tolist() )) )
+        print( "average of {0}".format(FLAGS.num_samples) )
+        print( ','.join(map(str, average_errors.tolist() )) )
+
+        store.write_errors( 'best_of_k', action, best_errors )
+        store.write_errors( 'average_of_k', action, average_errors )
 
   return
 
+def export():
+  """Export a checkpoint to TorchScript or ONNX, and compare its outputs and latency with the eager model"""
+
+  if FLAGS.load <= 0:
+    raise ValueError("Must give an iteration to read parameters from")
+
+  actions = define_actions( FLAGS.action )
+  model, _ = create_model(actions, sampling=True)
+  model.eval().to(device)
+
+  export_path = os.path.normpath(os.path.join(train_dir, export_filename(FLAGS.export_format)))
+  if FLAGS.export_format == "onnx":
+    onnx_model.export_onnx(model, export_path)
+    exported = create_forecaster(model, "onnx")
+  else:
+    script_model.export_torchscript(model, export_path)
+    exported = script_model.load_scripted(export_path, device)
+  print("Exported to {0}".format(export_path))
+
+  eager = create_forecaster(model, "torch")
+
+  # Check both give the same predictions. The decoder of a stochastic model
+  # draws its noise one frame at a time from the generator it is given, and
+  # the export is given the same draws
+  encoder_input = torch.randn(model.source_seq_len-1, 8, model.input_size, device=device)
+  decoder_input = torch.randn(model.target_seq_len, 8, model.input_size, device=device)
+  with torch.no_grad():
+    if not model.stochastic:
+      eager_output = eager(encoder_input, decoder_input)
+      exported_output = exported(encoder_input, decoder_input)
+    else:
+      generator = torch.Generator(device=device)
+      generator.manual_seed(0)
+      noise = torch.cat([torch.randn(1, 8, model.HUMAN_SIZE, device=device, generator=generator)
+                         for _ in range(model.target_seq_len)])
+      generator.manual_seed(0)
+      eager_output = model(encoder_input, decoder_input, generator)[2]
+      exported_output = exported(encoder_input, decoder_input, noise)
+  print("Max abs difference with the eager model: {0:.3e}".format(
+    (eager_output - exported_output).abs().max().item()))
+
+  print("{0: <12} | {1: >10} | {2: >11} | {3: >12}".format("batch size", "eager ms", "export ms", "ms per frame"))
+  for batch_size in [1, 8, 32]:
+    encoder_input = torch.randn(model.source_seq_len-1, batch_size, model.input_size, device=device)
+    decoder_input = torch.randn(model.target_seq_len, batch_size, model.input_size, device=device)
+    eager_ms = script_model.measure_latency(eager, encoder_input, decoder_input)
+    exported_ms = script_model.measure_latency(exported, encoder_input, decoder_input)
+    print("{0: <12} | {1:10.3f} | {2:11.3f} | {3:12.3f}".format(
+      batch_size, eager_ms, exported_ms, exported_ms / model.target_seq_len))
+
+def export_filename( export_format ):
+  """Name of the file of the checkpoint given by --load exported to a format"""
+  if export_format == "onnx":
+    return 'onnx-checkpoint-{0}.onnx'.format(FLAGS.load)
+  return 'scripted-checkpoint-{0}.pt'.format(FLAGS.load)
+
+def create_eval_forecaster( model, step ):
+  """
+  Forecaster of the srnn validation during training. With --backend onnx, the
+  model is exported at its current weights, next to its checkpoints, so that
+  the errors are those of the exported graph. None runs the model itself.
+  """
+  if FLAGS.backend == "torch":
+    return None
+  path = os.path.normpath(os.path.join(train_dir, 'onnx-checkpoint-{0}.onnx'.format(step)))
+  onnx_model.export_onnx(model, path)
+  return create_forecaster(model, "onnx", path)
+
+def create_forecaster( model, backend, path=None ):
+  """
+  Function that predicts the frames of a batch, with the model itself or with
+  its ONNX export, saved by --export --export_format onnx.
+
+  Args
+    model: the Seq2SeqModel
+    backend: "torch" or "onnx"
+    path: the ONNX export to run, that of the checkpoint given by --load if None
+  Returns
+    forecast: function of (encoder_input, decoder_input) returning the
+      target_seq_len * batch * input_size predicted frames (the samples of a
+      stochastic model), as a tensor on the device of the inputs. The ONNX one
+      also takes the noise of a stochastic model as a third argument.
+  """
+  if backend == "onnx":
+    if path is None:
+      path = os.path.normpath(os.path.join(train_dir, export_filename("onnx")))
+    forecaster = onnx_model.OnnxForecaster(path)
+    def forecast(encoder_input, decoder_input, noise=None):
+      output = forecaster.predict(encoder_input.cpu().numpy(), decoder_input.cpu().numpy(),
+                                  noise.cpu().numpy() if noise is not None else None)
+      return torch.from_numpy(output).to(encoder_input.device)
+    return forecast
+  return lambda encoder_input, decoder_input: model(encoder_input, decoder_input)[0 if not model.stochastic else 2]
+
+def quantize():
+  """Quantize a checkpoint to INT8, and compare its srnn errors and latency with the fp32 model"""
+
+  if FLAGS.load <= 0:
+    raise ValueError("Must give an iteration to read parameters from")
+  if device.type != 'cpu':
+    raise ValueError("Quantized models only run on the CPU, use --use_cpu")
+
+  actions = define_actions( FLAGS.action )
+  model, _ = create_model(actions, sampling=True)
+  model.eval()
+
+  train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use = read_all_data(
+    actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, FLAGS.cache_dir, FLAGS.data_workers )
+  srnn_fixtures = load_srnn_fixtures( actions, model, test_set, data_mean, data_std, dim_to_use )
+
+  forward = lambda encoder_input, decoder_input: model(encoder_input, decoder_input)
+  batch_sizes = [1, 8, 32]
+  def measure():
+    latencies = []
+    for batch_size in batch_sizes:
+      encoder_input = torch.randn(model.source_seq_len-1, batch_size, model.input_size)
+      decoder_input = torch.randn(model.target_seq_len, batch_size, model.input_size)
+      latencies.append( script_model.measure_latency(forward, encoder_input, decoder_input) )
+    return latencies
+
+  # The model is quantized in place, so everything about fp32 is measured first.
+  # With --backend onnx, the fp32 errors are those of the ONNX export of the checkpoint
+  fp32_errors, _, _ = evaluate_srnn( model, srnn_fixtures, create_forecaster(model, FLAGS.backend) )
+  fp32_latencies = measure()
+  fp32_checkpoint = io.BytesIO()
+  torch.save(model.state_dict(), fp32_checkpoint)
+
+  quantization.quantize_model(model)
+  quantized_path = os.path.normpath(os.path.join(train_dir, 'quantized-checkpoint-{0}.pt'.format(FLAGS.load)))
+  quantization.save_quantized(model, quantized_path)
+  print("Saved the quantized model to {0}".format(quantized_path))
+
+  int8_errors, _, _ = evaluate_srnn( model, srnn_fixtures )
+  int8_latencies = measure()
+
+  for name, errors in [("fp32", fp32_errors), ("int8", int8_errors)]:
+    print()
+    print("== {0} ==".format(name))
+    print_srnn_errors( actions, errors )
+  print()
+  print("== mean over actions ==")
+  print_srnn_errors( ["fp32", "int8"], np.stack([np.mean(fp32_errors, 0), np.mean(int8_errors, 0)]) )
+
+  print()
+  print("{0: <12} | {1: >10} | {2: >10} | {3: >8}".format("batch size", "fp32 ms", "int8 ms", "speedup"))
+  for batch_size, fp32_ms, int8_ms in zip(batch_sizes, fp32_latencies, int8_latencies):
+    print("{0: <12} | {1:10.3f} | {2:10.3f} | {3:7.2f}x".format(batch_size, fp32_ms, int8_ms, fp32_ms / int8_ms))
+  print("Checkpoint size: {0:.1f} MB fp32, {1:.1f} MB int8".format(
+    len(fp32_checkpoint.getvalue()) / 2**20, os.path.getsize(quantized_path) / 2**20))
+
+def serve():
+  """Serve online forecasts of a checkpoint, batching the requests of concurrent streams"""
+
+  if FLAGS.load <= 0:
+    raise ValueError("Must give an iteration to read parameters from")
+
+  actions = define_actions( FLAGS.action )
+  model, _ = create_model(actions, sampling=True)
+  model.eval().to(device)
+
+  # Only the normalization stats of the training data are needed
+  if FLAGS.cache_dir:
+    data_mean, data_std, _, dim_to_use = data_cache.load_stats( FLAGS.cache_dir, [1,6,7,8,9,11], actions, not FLAGS.omit_one_hot )
+  else:
+    _, _, data_mean, data_std, _, dim_to_use = read_all_data(
+      actions, FLAGS.seq_length_in, FLAGS.seq_length_out, FLAGS.data_dir, not FLAGS.omit_one_hot, None, FLAGS.data_workers )
+
+  predictor = online.OnlinePredictor( model, data_mean, data_std, dim_to_use, actions, device )
+  service = server.InferenceServer( predictor, FLAGS.max_batch, FLAGS.max_wait_ms / 1000 )
+  try:
+    asyncio.run( service.serve( FLAGS.serve_socket or None, port=FLAGS.serve_port, stats_every=FLAGS.stats_every ) )
+  except KeyboardInterrupt:
+    print( json.dumps(service.metrics.summary()) )
+
 def define_actions( action ):
   """
   Define the list of actions we are using.
@@ -583,7 +959,7 @@ def define_actions( action ):
   raise( ValueError, "Unrecognized action: %d" % action )
 
 
-def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot ):
+def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot, cache_dir=None, num_workers=None ):
   """
   Loads data for training/testing and normalizes it.
 
@@ -593,6 +969,8 @@ def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot ):
     seq_length_out: number of frames to use in the output sequence
     data_dir: directory to load the data from
     one_hot: whether to use one-hot encoding per action
+    cache_dir: directory of the preprocessed dataset cache, None to read the .txt files
+    num_workers: number of processes used to parse the .txt files
   Returns
     train_set: dictionary with normalized training data
     test_set: dictionary with test data
@@ -609,11 +987,16 @@ def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot ):
   train_subject_ids = [1,6,7,8,9,11]
   test_subject_ids = [5]
 
-  train_set, complete_train = data_utils.load_data( data_dir, train_subject_ids, actions, one_hot )
-  test_set,  complete_test  = data_utils.load_data( data_dir, test_subject_ids,  actions, one_hot )
+  if cache_dir:
+    train_set, train_stats = data_cache.load_data( data_dir, cache_dir, train_subject_ids, actions, one_hot, num_workers )
+    test_set,  _           = data_cache.load_data( data_dir, cache_dir, test_subject_ids,  actions, one_hot, num_workers )
+    data_mean, data_std, dim_to_ignore, dim_to_use = train_stats
+  else:
+    train_set, complete_train = data_utils.load_data( data_dir, train_subject_ids, actions, one_hot, num_workers )
+    test_set,  complete_test  = data_utils.load_data( data_dir, test_subject_ids,  actions, one_hot, num_workers )
 
-  # Compute normalization stats
-  data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats(complete_train)
+    # Compute normalization stats
+    data_mean, data_std, dim_to_ignore, dim_to_use = data_utils.normalization_stats(complete_train)
 
   # Normalize -- subtract mean, divide by stdev
   train_set = data_utils.normalize_data( train_set, data_mean, data_std, dim_to_use, actions, one_hot )
@@ -623,8 +1006,28 @@ def read_all_data( actions, seq_length_in, seq_length_out, data_dir, one_hot ):
   return train_set, test_set, data_mean, data_std, dim_to_ignore, dim_to_use
 
 
+def preprocess():
+  """Build the preprocessed dataset cache for the train and test subjects"""
+  if not FLAGS.cache_dir:
+    raise ValueError("--preprocess needs a --cache_dir")
+
+  actions = define_actions( FLAGS.action )
+  for subject_ids in [[1,6,7,8,9,11], [5]]:
+    data_cache.build_cache( FLAGS.data_dir, FLAGS.cache_dir, subject_ids, actions, not FLAGS.omit_one_hot, FLAGS.data_workers )
+    data_cache.check_stats( FLAGS.cache_dir, subject_ids, actions, not FLAGS.omit_one_hot )
+  print("The normalization stats match np.mean and np.std over all the frames")
+
+
 if __name__ == "__main__":
-    if FLAGS.sample:
+    if FLAGS.preprocess:
+        preprocess()
+    elif FLAGS.export:
+        export()
+    elif FLAGS.quantize:
+        quantize()
+    elif FLAGS.serve:
+        serve()
+    elif FLAGS.sample:
         sample()
     elif FLAGS.irl_training:
         train_IRL()
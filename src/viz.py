@@ -6,6 +6,66 @@ import numpy as np
 import h5py
 import os
 from mpl_toolkits.mplot3d import Axes3D
+import forward_kinematics
+import sample_store
+
+def load_xyz( sample_name, action_name ):
+  """
+  Read the 3d points of a ground truth sequence and of its prediction from a
+  file of samples, written by sample_store or in the older format with a
+  dataset per sequence. The 3d points are computed from the expmap sequences
+  if the file does not have them.
+
+  Args
+    sample_name: h5 file written by translate.py --sample
+    action_name: name of the sequence, the action and the index of the seed, e.g. walking_0
+  Returns
+    xyz_gt: (n_gt, 96) array with the 3d points of the ground truth
+    xyz_pred: (n_pred, 96) array with the 3d points of the prediction
+  """
+  if sample_store.is_store( sample_name ):
+    action, seed = action_name.rsplit( '_', 1 )
+    with sample_store.SampleReader( sample_name ) as reader:
+      if 'xyz/gt' in reader:
+        return reader.get( 'xyz/gt', action, int(seed) ), reader.get( 'xyz/preds', action, int(seed) )
+      expmap_gt = reader.get( 'expmap/gt', action, int(seed) )
+      expmap_pred = reader.get( 'expmap/preds', action, int(seed) )
+  else:
+    with h5py.File( sample_name, 'r' ) as h5f:
+      if 'xyz/gt/'+action_name in h5f:
+        return h5f['xyz/gt/'+action_name][:], h5f['xyz/preds/'+action_name][:]
+      expmap_gt = h5f['expmap/gt/'+action_name][:]
+      expmap_pred = h5f['expmap/preds/'+action_name][:]
+
+  return forward_kinematics.canonical_xyz( expmap_gt, expmap_pred )
+
+def animate( fig, ob, xyz_gt, xyz_pred, fps=25 ):
+  """
+  Animation of a ground truth sequence followed by its prediction. The colours
+  of each frame only depend on its index, the prediction is drawn in purple
+  and green.
+
+  Args
+    fig: the figure of the axis of ob
+    ob: Ax3DPose to draw the poses with
+    xyz_gt: (n_gt, 96) array with the 3d points of the ground truth
+    xyz_pred: (n_pred, 96) array with the 3d points of the prediction
+    fps: frames per second
+  Returns
+    anim: matplotlib FuncAnimation
+  """
+  import matplotlib.animation as animation
+
+  nframes_gt = len( xyz_gt )
+  to_draw = np.concatenate( (xyz_gt, xyz_pred), axis=0 )
+
+  def update( i ):
+    if i < nframes_gt:
+      return ob.update( to_draw[i] )
+    return ob.update( to_draw[i], lcolor="#9b59b6", rcolor="#2ecc71" )
+
+  return animation.FuncAnimation( fig, update, frames=len(to_draw), interval=1000. / fps )
+
 
 class Ax3DPose(object):
   def __init__(self, ax, lcolor="#3498db", rcolor="#e74c3c"):